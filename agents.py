@@ -6,25 +6,103 @@ from langchain_core.messages import (
     ToolMessage,
 )
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessage, message_chunk_to_message
 import operator
+import time
 from typing import Sequence 
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import ToolMessage
 from langgraph.checkpoint import *
 from dotenv import load_dotenv
+from state import get_message_state
+from llm_cache import get_llm_cache, agent_cache_key, dump_message, load_message
+from context import prepare_context
+from metrics import LLM_CACHE, record_llm_call
 
 load_dotenv()
 
 llm = ChatOpenAI(model="gpt-4o", )
 
+# phases of a learning session, written by the tool nodes and read by the routers (see routers.py)
+PHASE_LESSON_PLANNED = "lesson_planned"  # getChunks prepared the lesson plan
+PHASE_TUTORING = "tutoring"  # start_signal woke up current_tutor
+PHASE_REPORTED = "reported"  # the current tutor wrote its progress report
+PHASE_FINISHED = "finished"  # start_signal found no more lesson steps
+
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], operator.add]
     sender: str
+    # structured routing state, the routers read these instead of searching the message contents
+    current_tutor: str
+    phase: str
+    lesson_plan: list  # the remaining {"agent", "content"} steps, a copy of the session LessonQueue (see state.py)
+    # context sent to the LLMs (see context.py): rolling summary of the messages before summarized_count,
+    # and the tokens of the last prompt compared to the tokens of the full history
+    conversation_summary: str
+    summarized_count: int
+    prompt_tokens: int
+    history_tokens: int
+
+def routing_updates(state, tool_messages) -> dict:
+    """
+    Builds the state update of a tool node from the tool outputs: the tool messages plus the
+    routing fields (current_tutor, phase) that the routers read.
+
+    Args:
+        state (AgentState): the state the tools were called with.
+        tool_messages (list): the ToolMessages returned by the ToolNode.
+
+    Returns:
+        dict: the update to apply to the graph state.
+    """
+    messages = []
+    update = {}
+    for message in tool_messages:
+        if message.name == 'getChunks' and message.content == 'continue':
+            update.update(phase=PHASE_LESSON_PLANNED, current_tutor=None)
+        elif message.name == 'start_signal':
+            if message.content == 'no_more_lesson':
+                update.update(phase=PHASE_FINISHED, current_tutor=None)
+            else:
+                update.update(phase=PHASE_TUTORING, current_tutor=message.content)
+                # new message instead of editing the state: the tutor is told to fetch its content first
+                message = ToolMessage(content=message.content + ' TUTOR AGENT PLEASE CALL YOUR TOOL',
+                                      name=message.name, tool_call_id=message.tool_call_id)
+        elif message.name == 'create_progress_report':
+            # the tutor is done, a stale current_tutor could be routed to again and pop the next tutor's step
+            update.update(phase=PHASE_REPORTED, current_tutor=None)
+        messages.append(message)
+    return {"messages": messages, **update}
+
+# Runs a ToolNode and records in the state what its tools did, for the routers
+async def tool_node_with_routing(state, config, tool_node):
+    result = await tool_node.ainvoke(state, config)
+    update = routing_updates(state, result["messages"])
+    try:
+        # saved with the checkpoint so a resumed session gets its remaining lesson steps back
+        update["lesson_plan"] = get_message_state().lessons.to_list()
+    except LookupError: # no client session (e.g. scripts)
+        pass
+    return update
 
 # Helper function to create a node for a given agent
-def agent_node(state, agent, name):
-    result = agent.invoke(state)
+async def agent_node(state, agent, name):
+    # the agent sees a window of the history, a summary of the older turns and the lesson content
+    state, context_update = await prepare_context(state)
+    # deterministic (temperature 0) agents are answered from the response cache when possible
+    cache_key = agent_cache_key(agent, state)
+    start = time.perf_counter()
+    cached = get_llm_cache().get(cache_key) if cache_key else None
+    if cache_key:
+        LLM_CACHE.inc(agent=name, result="miss" if cached is None else "hit")
+    if cached is not None:
+        result = load_message(cached)
+    else:
+        # ainvoke keeps the event loop free for the other sessions while the LLM answers
+        result = await agent.ainvoke(state)
+        if cache_key:
+            get_llm_cache().set(cache_key, dump_message(result))
+    record_llm_call(name, time.perf_counter() - start, cached is not None, context_update["prompt_tokens"], result)
     # We convert the agent output into a format that is suitable to append to the global state
     if isinstance(result, ToolMessage):
         pass
@@ -35,6 +113,91 @@ def agent_node(state, agent, name):
         # Since we have a strict workflow, we can
         # track the sender so we know who to pass to next.
         "sender": name,
+        **context_update,
+    }
+
+# markers written by the agents for the routers (see communicator_router, router_tutor), never shown to the learner
+STREAM_HIDDEN_MARKERS = ('go_orchestrator', 'REPORT DONE')
+
+def closes_tutor_turn(state, message) -> bool:
+    ''' the tutor is done (see router_tutor): its reply goes to the tracker and is never sent to the learner '''
+    return state.get('phase') == PHASE_REPORTED or "REPORT DONE" in message.content
+
+def reply_is_sent(state, message) -> bool:
+    ''' whether a router sends this reply to the learner with update_content (which replaces the streamed preview) '''
+    return not message.tool_calls and message.content != '' and not closes_tutor_turn(state, message)
+
+class DeltaFilter:
+    """
+    Removes the routing markers from the streamed deltas, the routers only strip them from the complete message.
+    A marker can be split over several chunks, so the end of the text that could start one is held back.
+    """
+
+    def __init__(self, markers=STREAM_HIDDEN_MARKERS):
+        self.markers = markers
+        self._pending = ''
+
+    def feed(self, text: str) -> str:
+        ''' returns the part of the text that can be shown '''
+        self._pending += text
+        for marker in self.markers:
+            self._pending = self._pending.replace(marker, '')
+        hold = max((n for marker in self.markers for n in range(1, len(marker)) if self._pending.endswith(marker[:n])), default=0)
+        split = len(self._pending) - hold
+        shown, self._pending = self._pending[:split], self._pending[split:]
+        return shown
+
+    def flush(self) -> str:
+        ''' the text held back when the reply ended without completing a marker '''
+        shown, self._pending = self._pending, ''
+        return shown
+
+# Same as agent_node, but the reply is streamed token by token to the client while it is generated
+# cacheable=False never answers the agent from the response cache, even at temperature 0
+async def streaming_agent_node(state, agent, name, cacheable=True):
+    try:
+        message_state = get_message_state()
+    except LookupError: # graph run without a client session (e.g. scripts), nothing to stream to
+        message_state = None
+    state, context_update = await prepare_context(state)
+    cache_key = agent_cache_key(agent, state) if cacheable else None
+    start = time.perf_counter()
+    cached = get_llm_cache().get(cache_key) if cache_key else None
+    if cache_key:
+        LLM_CACHE.inc(agent=name, result="miss" if cached is None else "hit")
+    if cached is not None: # nothing to stream, the complete reply is sent by the routers
+        result = load_message(cached)
+    else:
+        gathered = None
+        deltas = DeltaFilter()
+        streamed = False
+        async for chunk in agent.astream(state):
+            gathered = chunk if gathered is None else gathered + chunk
+            # tool calls are not shown to the user, only forward plain text replies
+            if message_state is not None and chunk.content and not gathered.tool_call_chunks:
+                shown = deltas.feed(chunk.content)
+                if shown:
+                    message_state.push_delta(shown, name)
+                    streamed = True
+        # the routers inspect a complete AIMessage, so the chunks are merged back into one
+        result = message_chunk_to_message(gathered)
+        if message_state is not None:
+            rest = deltas.flush()
+            if not reply_is_sent(state, result):
+                # text followed by a tool call, or the closing reply of a tutor: no complete message
+                # will replace the preview, the client drops it
+                if streamed:
+                    message_state.discard_deltas(name)
+            elif rest:
+                message_state.push_delta(rest, name)
+        if cache_key:
+            get_llm_cache().set(cache_key, dump_message(result))
+    record_llm_call(name, time.perf_counter() - start, cached is not None, context_update["prompt_tokens"], result)
+    result = AIMessage(**result.dict(exclude={"type", "name"}), name=name)
+    return {
+        "messages": [result],
+        "sender": name,
+        **context_update,
     }
 
 def set_agent_prompt(agentName: str, tools) -> str:
@@ -0,0 +1,85 @@
+'''
+File-backed checkpointer for the graph.
+Lesson state is written to a SQLite file (WAL mode) instead of ":memory:", so a learner can resume
+a conversation after a restart and several workers can share the same file.
+Old checkpoints are pruned per thread, only the most recent ones are needed to resume.
+The AsyncSqliteSaver of langgraph 0.1.5 has no delete API, so the pruning deletes from its checkpoints
+table (thread_id, thread_ts) with its connection and lock: langgraph is pinned to that version in
+requirements.txt, and the pruning is skipped if the table has another layout.
+'''
+
+import os
+
+from langgraph.checkpoint.aiosqlite import AsyncSqliteSaver
+
+# path of the checkpoint database, can be overridden in the .env file
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "data/checkpoints.sqlite")
+# number of checkpoints kept for each conversation (thread) when pruning
+CHECKPOINTS_KEPT_PER_THREAD = int(os.getenv("CHECKPOINTS_KEPT_PER_THREAD", "20"))
+
+
+def create_checkpointer(path: str = CHECKPOINT_DB_PATH) -> AsyncSqliteSaver:
+    """
+    Creates the checkpointer used to compile the graph.
+    The connection is only opened when the graph first uses it, inside the running event loop.
+
+    Args:
+        path (str): path of the SQLite file, created if it does not exist.
+
+    Returns:
+        AsyncSqliteSaver: the checkpointer.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return AsyncSqliteSaver.from_conn_string(path)
+
+
+async def configure_checkpointer(saver: AsyncSqliteSaver):
+    """
+    Opens the connection, creates the tables and switches the database to WAL mode,
+    so readers (other workers resuming a session) do not block the writer.
+    """
+    await saver.setup()
+    async with saver.conn.execute("PRAGMA journal_mode=WAL;"):
+        pass
+    # with WAL, NORMAL is still safe against corruption and avoids an fsync on every checkpoint
+    async with saver.conn.execute("PRAGMA synchronous=NORMAL;"):
+        pass
+
+
+async def prune_checkpoints(saver: AsyncSqliteSaver, keep_last: int = CHECKPOINTS_KEPT_PER_THREAD, thread_id: str = None) -> int:
+    """
+    Deletes all but the most recent checkpoints of each thread.
+
+    Args:
+        saver (AsyncSqliteSaver): the checkpointer of the graph.
+        keep_last (int): number of checkpoints kept per thread.
+        thread_id (str): only prune this thread, all threads are pruned when None.
+
+    Returns:
+        int: the number of deleted checkpoints.
+    """
+    await saver.setup()
+    async with saver.conn.execute("PRAGMA table_info(checkpoints)") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if not {"thread_id", "thread_ts"} <= columns:
+        print(f"[WARNING] - checkpoints table of another langgraph version ({sorted(columns)}), not pruning")
+        return 0
+    query = """
+        DELETE FROM checkpoints WHERE rowid IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY thread_ts DESC) AS position
+                FROM checkpoints {where}
+            ) WHERE position > ?
+        )
+    """
+    if thread_id is None:
+        query, params = query.format(where=""), (keep_last,)
+    else:
+        query, params = query.format(where="WHERE thread_id = ?"), (str(thread_id), keep_last)
+    async with saver.lock:
+        async with saver.conn.execute(query, params) as cursor:
+            deleted = cursor.rowcount
+        await saver.conn.commit()
+    return deleted
@@ -0,0 +1,219 @@
+'''
+Context management for the agents.
+AgentState.messages keeps the whole conversation (operator.add), and every tutor turn used to send all of
+it to GPT-4o, so prompt tokens and latency grew with each turn. Before an agent is called, the history is
+reduced to:
+- a rolling summary of the older turns, extended incrementally every CONTEXT_SUMMARY_BATCH messages.
+  The summary is written in the background while the learner reads and answers, and used from the next
+  agent call, so it never adds an LLM round trip in front of a reply
+- the lesson content of the current step (the last getLearningContent call and its result), always kept
+- a sliding window of the last CONTEXT_WINDOW_MESSAGES messages
+Tool calls are never separated from their results. The full history stays in the graph state.
+'''
+
+import asyncio
+import os
+from collections import OrderedDict
+
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage
+
+from state import get_message_state
+
+# number of recent messages always sent as they are
+CONTEXT_WINDOW_MESSAGES = int(os.getenv("CONTEXT_WINDOW_MESSAGES", "12"))
+# the summary is extended once this many messages have left the window
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "8"))
+# model writing the summary, a small one is enough
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "gpt-4o-mini")
+# longer messages (e.g. the user files returned by getFiles) are cut before being summarized
+CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "1500"))
+TOKENIZER_MODEL = "gpt-4o"
+
+SUMMARY_PROMPT = (
+    "You keep the memory of a Luxembourgish tutoring session. Update the summary with the new messages. "
+    "Keep what the learner already saw, answered correctly or struggled with, their name and preferences, "
+    "the chosen Kapitel/Thema and which tutors already taught. Be brief, at most 200 words."
+)
+
+# messages counted by count_tokens, keyed by their text (most messages are counted again every turn)
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "10000"))
+
+_encoder = None
+_summarizer = None
+_token_counts = OrderedDict()
+
+
+def load_encoder():
+    """
+    Loads the tiktoken encoding of TOKENIZER_MODEL, downloaded on first use. Called at startup (see mainapp.py)
+    so no graph node waits for it, count_tokens estimates the counts until it is loaded.
+
+    Returns:
+        the encoder, or False if tiktoken is not available.
+    """
+    global _encoder
+    if _encoder is None:
+        try:
+            import tiktoken
+            try:
+                _encoder = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+            except KeyError:
+                _encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # without the encodings (no network for the download...) the count is estimated
+            print(f"[WARNING] - tiktoken unavailable ({e}), token counts are estimated")
+            _encoder = False
+    return _encoder
+
+
+def _message_tokens(message) -> int:
+    text = message.content if isinstance(message.content, str) else str(message.content)
+    for call in getattr(message, 'tool_calls', None) or []:
+        text += call["name"] + str(call["args"])
+    if not _encoder:  # not loaded (yet), never loaded from a node
+        return 4 + len(text) // 4
+    count = _token_counts.get(text)
+    if count is None:
+        count = _token_counts[text] = 4 + len(_encoder.encode(text))
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    else:
+        _token_counts.move_to_end(text)
+    return count
+
+
+def count_tokens(messages) -> int:
+    """
+    Counts the prompt tokens of a list of messages (content, tool calls and the per message overhead).
+    Each message is only tokenized once, the history sent again every turn is counted from a cache.
+
+    Returns:
+        int: the number of tokens, estimated as characters / 4 until load_encoder succeeded.
+    """
+    return sum(_message_tokens(message) for message in messages)
+
+
+def _window_start(messages, size: int) -> int:
+    ''' index of the first message of the window, moved back so no tool result loses its tool call '''
+    start = max(0, len(messages) - size)
+    while start > 0 and isinstance(messages[start], ToolMessage):
+        start -= 1
+    return start
+
+
+def _lesson_content(messages, before: int) -> list:
+    ''' the last getLearningContent call before index `before`, with all the tool results of that call '''
+    for i in range(before - 1, -1, -1):
+        message = messages[i]
+        if isinstance(message, ToolMessage) and message.name == 'getLearningContent':
+            parent = i
+            while parent > 0 and isinstance(messages[parent], ToolMessage):
+                parent -= 1
+            end = parent + 1
+            while end < len(messages) and isinstance(messages[end], ToolMessage):
+                end += 1
+            return list(messages[parent:end])
+    return []
+
+
+def _transcript(messages) -> str:
+    lines = []
+    for message in messages:
+        speaker = message.name or message.type
+        text = message.content if isinstance(message.content, str) else str(message.content)
+        if getattr(message, 'tool_calls', None):
+            text += f" [calls {', '.join(call['name'] for call in message.tool_calls)}]"
+        if len(text) > CONTEXT_SUMMARY_MAX_CHARS:
+            text = text[:CONTEXT_SUMMARY_MAX_CHARS] + '...'
+        if text.strip():
+            lines.append(f"{speaker}: {text}")
+    return '\n'.join(lines)
+
+
+async def summarize(previous_summary: str, messages) -> str:
+    """
+    Extends the rolling summary with messages that left the window.
+
+    Returns:
+        str: the new summary.
+    """
+    global _summarizer
+    if _summarizer is None:
+        from langchain_openai import ChatOpenAI
+        _summarizer = ChatOpenAI(model=CONTEXT_SUMMARY_MODEL, temperature=0)
+    result = await _summarizer.ainvoke([
+        SystemMessage(content=SUMMARY_PROMPT),
+        HumanMessage(content=f"Current summary:\n{previous_summary or '(empty)'}\n\nNew messages:\n{_transcript(messages)}"),
+    ])
+    return result.content
+
+
+async def _extend_summary(previous_summary: str, messages, summarized: int, start: int) -> tuple:
+    ''' summarizes messages[summarized:start], returns (summarized, new summary, start) '''
+    return summarized, await summarize(previous_summary, messages[summarized:start]), start
+
+
+def _session():
+    try:
+        return get_message_state()
+    except LookupError:  # no client session (e.g. scripts)
+        return None
+
+
+async def prepare_context(state, window: int = CONTEXT_WINDOW_MESSAGES, batch: int = CONTEXT_SUMMARY_BATCH):
+    """
+    Builds the state an agent is called with, and the update of the context fields of AgentState.
+
+    Args:
+        state (AgentState): the graph state with the full history.
+        window (int): number of recent messages sent as they are.
+        batch (int): number of messages folded into the summary at once.
+
+    Returns:
+        tuple: (state with the reduced messages, dict with conversation_summary, summarized_count,
+        prompt_tokens and history_tokens).
+    """
+    messages = list(state["messages"])
+    summary = state.get("conversation_summary") or ""
+    summarized = state.get("summarized_count") or 0
+    start = _window_start(messages, window)
+
+    session = _session()
+    task = session.summary_task if session is not None else None
+    if task is not None and task.done():
+        session.summary_task = None
+        try:
+            base, new_summary, upto = task.result()
+            if base == summarized:  # written from the summary of this state
+                summary, summarized = new_summary, upto
+        except Exception as e:
+            # the messages stay in the context until the next try, nothing is lost
+            print(f"[WARNING] - could not update the conversation summary: {e}")
+
+    if start - summarized >= batch:
+        if session is None:
+            # no session to keep the background task, the summary is written before the call
+            try:
+                _, summary, summarized = await _extend_summary(summary, messages, summarized, start)
+            except Exception as e:
+                print(f"[WARNING] - could not update the conversation summary: {e}")
+        elif session.summary_task is None:
+            # used from the next call, this one still sends the messages that are being summarized
+            session.summary_task = asyncio.ensure_future(_extend_summary(summary, messages, summarized, start))
+            session.summary_task.add_done_callback(lambda task: task.cancelled() or task.exception())  # reported when taken
+    # messages not summarized yet are still sent, the window only grows until the next summary
+    start = min(start, summarized)
+
+    context = []
+    if summary:
+        context.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+    context.extend(_lesson_content(messages, start))
+    context.extend(messages[start:])
+
+    update = {
+        "conversation_summary": summary,
+        "summarized_count": summarized,
+        "prompt_tokens": count_tokens(context),
+        "history_tokens": count_tokens(messages),
+    }
+    return {**state, "messages": context}, update
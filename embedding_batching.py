@@ -0,0 +1,114 @@
+'''
+Micro-batching of the query embeddings of the retrieval path (see retrieval.py).
+When several sessions reach the orchestrator together, each getChunks call used to encode its query
+on its own. The queries arriving within a few milliseconds are now collected and encoded in one forward
+pass of the embedding model (embed_documents with the query instruction, as embed_query does), and each
+caller gets its own vector back. Only one batch runs at a time: the queries arriving meanwhile wait for it
+and form the next batch, so a burst is encoded in a few large batches instead of many concurrent small ones.
+'''
+
+import asyncio
+import os
+import time
+
+from embeddings import query_instruction
+from metrics import EMBEDDING_BATCH_QUERIES, EMBEDDING_QUEUE_SECONDS
+
+# maximum number of queries embedded in one batch, 1 disables batching
+EMBEDDING_QUERY_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_QUERY_BATCH_MAX_SIZE", "16"))
+# how long the first query of a batch waits for others (in milliseconds)
+EMBEDDING_QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_QUERY_BATCH_MAX_WAIT_MS", "5"))
+
+
+def embed_queries(embeddings, queries: list, model_name: str) -> list:
+    """
+    Embeds several queries in one forward pass, with the same vectors as embed_query.
+
+    Args:
+        embeddings: the embedding model (see embeddings.create_embeddings).
+        queries (list): the query texts.
+        model_name (str): the bge model, it decides the query instruction.
+
+    Returns:
+        list: one vector per query.
+    """
+    instruction = query_instruction(model_name)
+    return embeddings.embed_documents([instruction + query.replace("\n", " ") for query in queries])
+
+
+class QueryEmbeddingBatcher:
+    """
+    Collects the queries arriving within max_wait_ms and embeds them as one batch in a worker thread.
+    """
+
+    def __init__(self, embed_batch, max_batch_size: int = EMBEDDING_QUERY_BATCH_MAX_SIZE,
+                 max_wait_ms: float = EMBEDDING_QUERY_BATCH_MAX_WAIT_MS):
+        """
+        Args:
+            embed_batch (callable): embeds a list of queries, returns one vector per query (blocking).
+            max_batch_size (int): a batch is sent as soon as it has this many queries.
+            max_wait_ms (float): latency budget, a batch is sent at the latest this long after its first query.
+        """
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._waiting = []  # [(query, time queued, future)]
+        self._timer = None
+        self._running = False
+        self.batches = 0
+        self.batched_queries = 0
+
+    async def embed(self, query: str) -> list:
+        """
+        Queues a query for the next batch and returns its embedding.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiting.append((query, time.perf_counter(), future))
+        if len(self._waiting) >= self.max_batch_size:
+            self._send()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._send)
+        return await future
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._running:  # the running batch sends the waiting queries when it is done
+            return
+        self._waiting = [entry for entry in self._waiting if not entry[2].cancelled()]
+        batch, self._waiting = self._waiting[:self.max_batch_size], self._waiting[self.max_batch_size:]
+        if batch:
+            self._running = True
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        now = time.perf_counter()
+        for _, queued, _ in batch:
+            EMBEDDING_QUEUE_SECONDS.observe(now - queued)
+        EMBEDDING_BATCH_QUERIES.observe(len(batch))
+        self.batches += 1
+        self.batched_queries += len(batch)
+        try:
+            vectors = await asyncio.to_thread(self.embed_batch, [query for query, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, _, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        finally:
+            self._running = False
+            if self._waiting:
+                self._send()
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_queries / self.batches if self.batches else None,
+        }
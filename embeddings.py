@@ -0,0 +1,138 @@
+'''
+Embedding backends of the retrieval path (retrieval.py and ingest.py), selected by configuration.
+- hf: sentence-transformers through langchain's HuggingFaceBgeEmbeddings (PyTorch), the original backend
+- onnx: the same bge model exported to ONNX and run with ONNX Runtime, optionally quantized to int8
+  (dynamic quantization), which is several times faster on CPU and much smaller in memory.
+  It needs the optional optimum[onnxruntime] package (requirements-onnx.txt), the exported model is kept in EMBEDDING_ONNX_DIR.
+Smaller bge variants (BAAI/bge-small-en-v1.5, BAAI/bge-base-en-v1.5) are selected with EMBEDDING_MODEL.
+The store must be embedded with the same backend and model as the queries, ingest.py re-embeds it when they change.
+Compare the configurations with scripts/bench_embeddings.py.
+'''
+
+import os
+import re
+
+import numpy as np
+
+# "hf" or "onnx"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hf")
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "BAAI/bge-large-en-v1.5")
+# "int8" to quantize the ONNX export, empty to keep it in float32
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "int8")
+# where the ONNX exports are kept, the export only happens once per model
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "data/onnx")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+# prefix added to the queries (not the documents) of the English bge models, as langchain does
+BGE_QUERY_INSTRUCTION_EN = "Represent this question for searching relevant passages: "
+
+
+def query_instruction(model_name: str) -> str:
+    ''' the bge v1.5 English models are trained with an instruction before the queries '''
+    return BGE_QUERY_INSTRUCTION_EN if "bge" in model_name.lower() and "-en" in model_name.lower() else ""
+
+
+def embedding_signature(backend: str = EMBEDDING_BACKEND, model_name: str = EMBEDDING_MODEL_NAME,
+                        quantize: str = EMBEDDING_QUANTIZE) -> str:
+    ''' identifies the vectors a configuration produces, written in the store metadata by ingest.py '''
+    if backend == "hf":
+        return model_name
+    return f"{model_name}:{backend}" + (f"-{quantize}" if quantize else "")
+
+
+class OnnxBgeEmbeddings:
+    """
+    bge embeddings (CLS pooling, normalized) computed with ONNX Runtime.
+    Same interface as the langchain embeddings: embed_documents and embed_query.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, quantize: str = EMBEDDING_QUANTIZE,
+                 export_dir: str = EMBEDDING_ONNX_DIR, batch_size: int = EMBEDDING_BATCH_SIZE):
+        """
+        Args:
+            model_name (str): the HuggingFace bge model, exported to ONNX on first use.
+            quantize (str): "int8" for dynamic int8 quantization, empty for float32.
+            export_dir (str): directory of the exported models.
+            batch_size (int): number of texts encoded at once.
+        """
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+        except ImportError as e:
+            raise ImportError("the onnx embedding backend needs optimum: pip install -r requirements-onnx.txt") from e
+        from transformers import AutoTokenizer
+
+        if quantize not in ("", None, "int8"):
+            raise ValueError(f"Unknown EMBEDDING_QUANTIZE: {quantize} (expected 'int8' or empty)")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.query_instruction = query_instruction(model_name)
+        path = self._export(model_name, quantize, export_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            path, file_name="model_quantized.onnx" if quantize else "model.onnx")
+
+    @staticmethod
+    def _export(model_name: str, quantize: str, export_dir: str) -> str:
+        ''' exports (and quantizes) the model once, returns the directory to load it from '''
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        base = os.path.join(export_dir, re.sub(r'[^\w.-]', '_', model_name))
+        path = base + ("-int8" if quantize else "")
+        if os.path.exists(os.path.join(path, "model_quantized.onnx" if quantize else "model.onnx")):
+            return path
+        if not os.path.exists(os.path.join(base, "model.onnx")):
+            print(f"[INFO] - exporting {model_name} to ONNX in {base}")
+            ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(base)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(base)
+        if quantize:
+            print(f"[INFO] - quantizing {model_name} to int8 in {path}")
+            quantizer = ORTQuantizer.from_pretrained(base)
+            # dynamic quantization: the weights are int8, the activations are quantized at run time
+            quantizer.quantize(save_dir=path, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+            AutoTokenizer.from_pretrained(base).save_pretrained(path)
+        return path
+
+    def _encode(self, texts: list) -> list:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[i:i + self.batch_size], padding=True, truncation=True,
+                                    max_length=512, return_tensors="np")
+            output = self.model(**inputs).last_hidden_state[:, 0]  # CLS pooling, as bge
+            output = np.asarray(output, dtype=np.float32)
+            vectors.extend((output / np.linalg.norm(output, axis=1, keepdims=True)).tolist())
+        return vectors
+
+    def embed_documents(self, texts: list) -> list:
+        return self._encode([text.replace("\n", " ") for text in texts])
+
+    def embed_query(self, text: str) -> list:
+        return self._encode([self.query_instruction + text.replace("\n", " ")])[0]
+
+
+def create_embeddings(backend: str = EMBEDDING_BACKEND, model_name: str = EMBEDDING_MODEL_NAME,
+                      quantize: str = EMBEDDING_QUANTIZE):
+    """
+    Builds the embedding model of the vector store, shared by the retrieval service and ingest.py
+    so the queries and the chunks are always embedded the same way.
+
+    Args:
+        backend (str): "hf" or "onnx".
+        model_name (str): the HuggingFace bge model.
+        quantize (str): "int8" or empty, only used by the onnx backend.
+
+    Returns:
+        an object with embed_documents and embed_query.
+    """
+    if backend == "hf":
+        from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+        return HuggingFaceBgeEmbeddings(
+            model_name=model_name,
+            model_kwargs={'device': 'cpu'},
+            encode_kwargs={'normalize_embeddings': True},  # set True to compute cosine similarity
+            query_instruction=query_instruction(model_name),
+        )
+    if backend == "onnx":
+        return OnnxBgeEmbeddings(model_name, quantize)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend} (expected 'hf' or 'onnx')")
@@ -0,0 +1,157 @@
+'''
+Hybrid search over the chunks of the Chroma store (see ingest.py), used by retrieval.py.
+getChunks asks for lessons with queries like "Kapitel: 1 Thema: Moien", which the chunk metadata answers
+exactly, so a query is resolved in three steps:
+1. metadata: the Kapitel/Thema of the query are looked up in an in-memory index of the chunk metadata,
+   a match is returned right away without embedding the query
+2. otherwise the chunks are pre-filtered on the Kapitel (if the query has one) and ranked by a BM25 index
+3. and by the dense vectors of the store, the two rankings are fused with reciprocal rank fusion (RRF)
+'''
+
+import math
+import os
+from collections import Counter
+
+from lesson_plan import normalize_text, parse_query
+
+# k of reciprocal rank fusion, score = sum(1 / (k + rank)), higher values flatten the rankings
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+# number of candidates taken from each ranking before the fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+
+
+def tokenize(text: str) -> list:
+    ''' lowercase words without accents, so "Äddi" and "Addi" are the same token '''
+    return normalize_text(text).split()
+
+
+class BM25:
+    """
+    Okapi BM25 over a fixed list of documents, in pure Python.
+    """
+
+    def __init__(self, documents: list, k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            documents (list): the texts to index.
+            k1 (float): term frequency saturation.
+            b (float): document length normalization.
+        """
+        self.k1 = k1
+        self.b = b
+        self._frequencies = [Counter(tokenize(document)) for document in documents]
+        self._lengths = [sum(frequencies.values()) for frequencies in self._frequencies]
+        self._average_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        document_frequency = Counter(term for frequencies in self._frequencies for term in frequencies)
+        n = len(documents)
+        self._idf = {term: math.log((n - df + 0.5) / (df + 0.5) + 1) for term, df in document_frequency.items()}
+
+    def scores(self, query: str, candidates=None) -> dict:
+        """
+        Returns:
+            dict: document index -> score, for the candidate documents (all by default) containing a query term.
+        """
+        terms = [term for term in set(tokenize(query)) if term in self._idf]
+        candidates = range(len(self._frequencies)) if candidates is None else candidates
+        scores = {}
+        for i in candidates:
+            frequencies = self._frequencies[i]
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / (self._average_length or 1))
+            score = sum(self._idf[term] * frequencies[term] * (self.k1 + 1) / (frequencies[term] + norm)
+                        for term in terms if term in frequencies)
+            if score > 0:
+                scores[i] = score
+        return scores
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = HYBRID_RRF_K) -> list:
+    """
+    Fuses several rankings of the same items.
+
+    Args:
+        rankings (list): lists of items, best first.
+        k (int): the RRF constant.
+
+    Returns:
+        list: the items sorted by fused score, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda item: -scores[item])
+
+
+class HybridIndex:
+    """
+    Metadata and BM25 indexes of the chunks of the store, in file order.
+    Chunks without kapitel/thema metadata (a store not built by ingest.py) are only found by BM25 and the vectors.
+    """
+
+    def __init__(self, documents: list, metadatas: list):
+        """
+        Args:
+            documents (list): the chunk texts.
+            metadatas (list): the metadata dict of each chunk.
+        """
+        self.documents = documents
+        self.metadatas = [metadata or {} for metadata in metadatas]
+        self.bm25 = BM25(documents)
+        self._positions = {document: i for i, document in reversed(list(enumerate(documents)))}
+        self._lessons = {}  # kapitel -> [(normalized thema, [chunk indexes])]
+        for i, metadata in enumerate(self.metadatas):
+            kapitel = str(metadata.get("kapitel", "")).strip()
+            thema = normalize_text(metadata.get("thema", ""))
+            if not kapitel or not thema:
+                continue
+            lessons = self._lessons.setdefault(kapitel, [])
+            entry = next((entry for entry in lessons if entry[0] == thema), None)
+            if entry is None:
+                lessons.append((thema, [i]))
+            else:
+                entry[1].append(i)
+
+    @classmethod
+    def from_vectordb(cls, vectordb):
+        ''' reads every chunk of a langchain Chroma store '''
+        data = vectordb.get(include=["documents", "metadatas"])
+        return cls(data["documents"], data["metadatas"])
+
+    def __len__(self):
+        return len(self.documents)
+
+    def position(self, document: str):
+        ''' index of a chunk from its text, None if it is not indexed '''
+        return self._positions.get(document)
+
+    def match_lesson(self, query: str):
+        """
+        Chunks of the lesson named by the Kapitel/Thema of the query, matched like lookup_lesson_plan
+        (a shortened thema such as "Moien" matches "Moien!... an Addi!").
+
+        Returns:
+            list: the chunk indexes in file order, None if the query does not name a known lesson.
+        """
+        kapitel, thema = parse_query(query)
+        if kapitel is None or not thema:
+            return None
+        wanted = normalize_text(thema)
+        if len(wanted) < 3:
+            return None
+        for known, indexes in self._lessons.get(kapitel, []):
+            if wanted == known or known.startswith(wanted) or wanted.startswith(known):
+                return indexes
+        return None
+
+    def kapitel_filter(self, query: str):
+        ''' (chunk indexes, Chroma where filter) of the Kapitel of the query, (None, None) without one '''
+        kapitel, _ = parse_query(query)
+        if kapitel is None or kapitel not in self._lessons:
+            return None, None
+        indexes = [i for i, metadata in enumerate(self.metadatas) if str(metadata.get("kapitel", "")).strip() == kapitel]
+        return indexes, {"kapitel": kapitel}
+
+    def lexical(self, query: str, candidates=None, limit: int = HYBRID_CANDIDATES) -> list:
+        ''' the best BM25 chunk indexes, best first '''
+        scores = self.bm25.scores(query, candidates)
+        return sorted(scores, key=lambda i: (-scores[i], i))[:limit]
@@ -0,0 +1,216 @@
+'''
+Incremental ingestion of the curriculum content into the Chroma store read by retrieval.py.
+Every kapitel/thema/kategorie/agent/Inhalt block of data/relevant_content.txt becomes one chunk, whose id is
+the sha256 of its text. Updating the store only embeds the chunks that are new or changed (in batches),
+and deletes the chunks that are no longer in the content file, so a curriculum update costs seconds
+instead of a full re-embed. Kapitel, Thema, Kategorie and agent are stored as metadata of each chunk.
+The store is rebuilt from scratch when it was embedded with another model or backend (see embeddings.py).
+The lesson plan index (see lesson_plan.py) is rebuilt at the same time when the content changed.
+
+Run it when the content changes (or at deploy time). With INGEST_ON_STARTUP=1 the app also runs it at startup
+(see RetrievalService.sync_store), otherwise the startup only checks that the store metadata resolves the lessons.
+
+usage: python ingest.py [--content data/relevant_content.txt] [--persist data/bge_test_] [--rebuild] [--dry-run] [--check]
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from hybrid_search import HybridIndex
+from lesson_plan import CONTENT_PATH, INDEX_PATH, build_index, lesson_key, normalize_agent, parse_content_blocks
+from embeddings import EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, EMBEDDING_QUANTIZE, create_embeddings, embedding_signature
+from retrieval import PERSIST_DIRECTORY
+
+# collection used by langchain's Chroma wrapper when no name is given, the one retrieval.py reads
+COLLECTION_NAME = "langchain"
+# number of chunks embedded and written at once
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+
+
+def chunk_text(block: dict) -> str:
+    ''' text of a chunk, the header lines keep the chunk readable for the LLM that splits the retrieved docs '''
+    return (
+        f"Kapitel: {block['kapitel']}\n"
+        f"Thema: {block.get('thema', '')}\n"
+        f"Kategorie: {block.get('kategorie', '')}\n"
+        f"Agent: {block.get('agent', '')}\n"
+        f"Inhalt:\n{block['content']}"
+    )
+
+
+def chunk_id(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def build_chunks(blocks: list, source: str) -> dict:
+    """
+    Turns the content blocks into chunks keyed by their content hash.
+    A block repeated word for word is stored once.
+
+    Returns:
+        dict: id -> {"text": ..., "metadata": {...}}, in file order.
+    """
+    chunks = {}
+    for block in blocks:
+        if not block.get('content'):
+            continue
+        text = chunk_text(block)
+        chunks.setdefault(chunk_id(text), {
+            "text": text,
+            "metadata": {
+                "kapitel": str(block['kapitel']).strip(),
+                "thema": block.get('thema', ''),
+                "kategorie": block.get('kategorie', ''),
+                "agent": normalize_agent(block.get('agent', '')) or block.get('agent', ''),
+                "lesson": lesson_key(block['kapitel'], block.get('thema', '')),
+                "source": source,
+            },
+        })
+    return chunks
+
+
+def get_collection(persist_directory: str = PERSIST_DIRECTORY):
+    import chromadb
+    client = chromadb.PersistentClient(path=persist_directory)
+    return client.get_or_create_collection(COLLECTION_NAME)
+
+
+def plan_update(chunks: dict, stored_ids, same_model: bool = True) -> tuple:
+    """
+    Compares the chunks of the content file with the ids already in the store.
+
+    Returns:
+        tuple: (ids to embed and add, ids to delete)
+    """
+    stored_ids = set(stored_ids)
+    if not same_model:  # embeddings of two models cannot be compared, everything is embedded again
+        return list(chunks), sorted(stored_ids)
+    return [i for i in chunks if i not in stored_ids], sorted(stored_ids - set(chunks))
+
+
+def ingest(content_path: str = CONTENT_PATH, persist_directory: str = PERSIST_DIRECTORY,
+           backend: str = EMBEDDING_BACKEND, model_name: str = EMBEDDING_MODEL_NAME,
+           quantize: str = EMBEDDING_QUANTIZE, batch_size: int = INGEST_BATCH_SIZE,
+           rebuild: bool = False, dry_run: bool = False, embeddings=None) -> dict:
+    """
+    Brings the Chroma store up to date with the content file.
+
+    Args:
+        content_path (str): the curriculum content file.
+        persist_directory (str): directory of the persisted Chroma store.
+        backend (str): the embedding backend, "hf" or "onnx".
+        model_name (str): the embedding model, the one retrieval.py embeds the queries with.
+        quantize (str): "int8" or empty, for the onnx backend.
+        batch_size (int): number of chunks embedded at once.
+        rebuild (bool): embed every chunk again, even the unchanged ones.
+        dry_run (bool): only report what would change.
+        embeddings: an already loaded model of this backend and model_name (e.g. the one of the retrieval
+            service), created only when something has to be embedded otherwise.
+
+    Returns:
+        dict: the number of chunks in the file, added, deleted and unchanged, and the duration.
+    """
+    start = time.perf_counter()
+    chunks = build_chunks(parse_content_blocks(content_path), os.path.basename(content_path))
+    collection = get_collection(persist_directory)
+    stored_ids = collection.get(include=[])["ids"]
+    signature = embedding_signature(backend, model_name, quantize)
+    stored_model = (collection.metadata or {}).get("embedding_model")
+    same_model = not rebuild and stored_model == signature
+    if stored_ids and not same_model and not rebuild:
+        print(f"[INFO] - the store was embedded with {stored_model or 'an unknown model'}, embedding everything with {signature}")
+    to_add, to_delete = plan_update(chunks, stored_ids, same_model)
+
+    report = {
+        "chunks": len(chunks),
+        "added": len(to_add),
+        "deleted": len(to_delete),
+        "unchanged": len(chunks) - len(to_add),
+        "dry_run": dry_run,
+    }
+    if dry_run:
+        report["duration_s"] = round(time.perf_counter() - start, 3)
+        return report
+
+    if to_delete:
+        collection.delete(ids=to_delete)
+    if to_add:
+        # the model is only loaded when something has to be embedded
+        embeddings = embeddings or create_embeddings(backend, model_name, quantize)
+        for i in range(0, len(to_add), batch_size):
+            ids = to_add[i:i + batch_size]
+            texts = [chunks[chunk]["text"] for chunk in ids]
+            collection.add(
+                ids=ids,
+                embeddings=embeddings.embed_documents(texts),
+                documents=texts,
+                metadatas=[chunks[chunk]["metadata"] for chunk in ids],
+            )
+            print(f"[INFO] - embedded {min(i + batch_size, len(to_add))}/{len(to_add)} chunks")
+    if stored_model != signature:
+        collection.modify(metadata={**(collection.metadata or {}), "embedding_model": signature})
+
+    report["duration_s"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def check_metadata(index: HybridIndex, content_path: str = CONTENT_PATH) -> tuple:
+    """
+    Checks that the metadata stage of the retrieval (HybridIndex.match_lesson) answers the lessons of the
+    content file, which it only does for a store built by this module.
+
+    Args:
+        index (HybridIndex): the index of the store, as retrieval.py builds it.
+        content_path (str): the curriculum content file.
+
+    Returns:
+        tuple: (queries of the lessons resolved from the metadata, queries of every lesson of the file)
+    """
+    queries = {}
+    for block in parse_content_blocks(content_path):
+        if block.get('content') and block.get('thema'):
+            queries.setdefault(lesson_key(block['kapitel'], block['thema']), f"Kapitel: {block['kapitel']} Thema: {block['thema']}")
+    return [query for query in queries.values() if index.match_lesson(query)], list(queries.values())
+
+
+def refresh_lesson_plans(content_path: str = CONTENT_PATH, index_path: str = INDEX_PATH) -> bool:
+    ''' rebuilds the lesson plan index if it was built from another version of the content, True if it did '''
+    with open(content_path, 'rb') as file:
+        content_hash = hashlib.sha256(file.read()).hexdigest()
+    try:
+        with open(index_path, 'r', encoding='utf-8') as file:
+            if json.load(file).get('source_sha256') == content_hash:
+                return False
+    except (OSError, ValueError):
+        pass
+    build_index(content_path, index_path)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--content", default=CONTENT_PATH, help="curriculum content file")
+    parser.add_argument("--persist", default=PERSIST_DIRECTORY, help="directory of the Chroma store")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=["hf", "onnx"], help="embedding backend")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME, help="embedding model")
+    parser.add_argument("--quantize", default=EMBEDDING_QUANTIZE, help="'int8' or '' for the onnx backend")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--rebuild", action="store_true", help="embed every chunk again")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would change")
+    parser.add_argument("--check", action="store_true", help="only check that the store metadata resolves the lessons, exit 1 if it does not")
+    args = parser.parse_args()
+
+    if args.check:
+        data = get_collection(args.persist).get(include=["documents", "metadatas"])
+        resolved, lessons = check_metadata(HybridIndex(data["documents"], data["metadatas"]), args.content)
+        print(f"{len(resolved)}/{len(lessons)} lessons resolved from the chunk metadata")
+        sys.exit(0 if resolved or not lessons else 1)
+
+    print(json.dumps(ingest(args.content, args.persist, args.backend, args.model, args.quantize,
+                            args.batch_size, args.rebuild, args.dry_run), indent=4))
+    if not args.dry_run and refresh_lesson_plans(args.content):
+        print(f"[INFO] - lesson plan index rebuilt: {INDEX_PATH}")
@@ -0,0 +1,194 @@
+'''
+Precomputed lesson plans for the orchestrator.
+The Kapitel/Thema blocks of data/relevant_content.txt are static and already tagged with the agent that
+teaches them, so the split into (agent, content) pairs that getChunks used to ask GPT for is computed
+once, offline, and stored in data/lesson_plan_index.json.
+getChunks looks the requested lesson up in this index and only falls back to the LLM on a miss.
+
+build the index with: python lesson_plan.py
+'''
+
+import hashlib
+import json
+import os
+import re
+import unicodedata
+
+CONTENT_PATH = "data/relevant_content.txt"
+INDEX_PATH = "data/lesson_plan_index.json"
+
+# agent names exactly as the graph expects them (see graph_creation.py)
+TUTOR_AGENTS = ['conversational', 'listening', 'reader', 'questionAnswering', 'grammarSummary']
+_AGENT_ALIASES = {name.lower(): name for name in TUTOR_AGENTS}
+_AGENT_ALIASES.update({'reading': 'reader', 'qa': 'questionAnswering', 'grammar': 'grammarSummary'})
+
+_FIELD_PATTERN = re.compile(r'^-\s*(kapitel|thema|kategorie|agent)\s*:\s*(.*)$', re.IGNORECASE)
+
+
+def normalize_text(text: str) -> str:
+    ''' lowercase, no accents, no punctuation: "Moien!... an Äddi!" -> "moien an addi" '''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+
+def normalize_agent(agent: str) -> str:
+    ''' "conversational agent" -> "conversational", None if it is not a tutor agent '''
+    name = re.sub(r'\s*agent\s*$', '', agent.strip(), flags=re.IGNORECASE)
+    return _AGENT_ALIASES.get(name.replace(' ', '').lower())
+
+
+def lesson_key(kapitel, thema: str) -> str:
+    return f"{str(kapitel).strip()}|{normalize_text(thema)}"
+
+
+def parse_content_blocks(path: str = CONTENT_PATH) -> list:
+    """
+    Parses the kapitel/thema/kategorie/agent/Inhalt blocks of the curriculum content.
+
+    Args:
+        path (str): the content file.
+
+    Returns:
+        list: one dict per block with the keys kapitel, thema, kategorie, agent and content, in file order.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        lines = file.read().splitlines()
+
+    blocks = []
+    current = None
+    content_lines = None
+
+    def close_block():
+        if current is not None and content_lines is not None:
+            # drop the '-' separators and blank lines between blocks
+            while content_lines and content_lines[-1].strip() in ('', '-'):
+                content_lines.pop()
+            current['content'] = '\n'.join(content_lines).strip()
+            blocks.append(current)
+
+    for line in lines:
+        match = _FIELD_PATTERN.match(line.strip())
+        if match and match.group(1).lower() == 'kapitel' and (content_lines is not None or current is None):
+            close_block()
+            current = {'kapitel': match.group(2).strip()}
+            content_lines = None
+        elif match and current is not None and content_lines is None:
+            current[match.group(1).lower()] = match.group(2).strip()
+        elif line.strip().lower() == '**inhalt:**' and current is not None:
+            content_lines = []
+        elif content_lines is not None:
+            content_lines.append(line)
+    close_block()
+    return blocks
+
+
+def build_lesson_plans(blocks: list) -> dict:
+    """
+    Groups the blocks by lesson (Kapitel, Thema) into an ordered list of (agent, content) pairs.
+    Consecutive blocks taught by the same agent are merged into one lesson step.
+
+    Returns:
+        dict: lesson_key -> {"kapitel": ..., "thema": ..., "plan": [{"agent": ..., "content": ...}, ...]}
+    """
+    lessons = {}
+    for block in blocks:
+        agent = normalize_agent(block.get('agent', ''))
+        if agent is None or not block.get('content'):
+            print(f"[WARNING] - skipping block without a valid agent or content: {block.get('agent')}")
+            continue
+        key = lesson_key(block['kapitel'], block.get('thema', ''))
+        lesson = lessons.setdefault(key, {'kapitel': block['kapitel'], 'thema': block.get('thema', ''), 'plan': []})
+        plan = lesson['plan']
+        if plan and plan[-1]['agent'] == agent:
+            plan[-1]['content'] += '\n\n' + block['content']
+        else:
+            plan.append({'agent': agent, 'content': block['content']})
+    return lessons
+
+
+def _file_hash(path: str) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def build_index(content_path: str = CONTENT_PATH, index_path: str = INDEX_PATH) -> dict:
+    """
+    Parses the content file and writes the lesson plan index to disk.
+
+    Returns:
+        dict: the index that was written.
+    """
+    index = {
+        'source': content_path,
+        'source_sha256': _file_hash(content_path),
+        'lessons': build_lesson_plans(parse_content_blocks(content_path)),
+    }
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(index, file, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, index_path)  # readers never see a half written index
+    return index
+
+
+_index_cache = {'mtime': None, 'lessons': None}
+
+
+def load_index(index_path: str = INDEX_PATH) -> dict:
+    """
+    Returns the lessons of the index, reloaded only when the file changed.
+    Returns an empty dict if the index was not built.
+    """
+    try:
+        mtime = os.path.getmtime(index_path)
+    except OSError:
+        return {}
+    if _index_cache['mtime'] != mtime:
+        with open(index_path, 'r', encoding='utf-8') as file:
+            _index_cache['lessons'] = json.load(file)['lessons']
+        _index_cache['mtime'] = mtime
+    return _index_cache['lessons']
+
+
+def parse_query(query: str):
+    """
+    Extracts the Kapitel and Thema from an orchestrator query such as "Kapitel: 1 Thema: Moien".
+
+    Returns:
+        tuple: (kapitel, thema), either can be None if it is missing.
+    """
+    kapitel = re.search(r'kapitel\s*:?\s*(\d+)', query, re.IGNORECASE)
+    thema = re.search(r'thema\s*:?\s*(.+?)\s*(?:kapitel\s*:|$)', query, re.IGNORECASE | re.DOTALL)
+    return (kapitel.group(1) if kapitel else None,
+            thema.group(1).strip() if thema else None)
+
+
+def lookup_lesson_plan(query: str, index_path: str = INDEX_PATH):
+    """
+    Finds the precomputed plan of the lesson asked for in the query.
+    The thema may be shortened ("Moien" matches "Moien!... an Addi!") and is compared without accents or punctuation.
+
+    Returns:
+        list: the ordered [{"agent": ..., "content": ...}] pairs, or None if the lesson is not in the index.
+    """
+    kapitel, thema = parse_query(query)
+    if kapitel is None or not thema:
+        return None
+    wanted = normalize_text(thema)
+    if len(wanted) < 3:
+        return None
+    for lesson in load_index(index_path).values():
+        if str(lesson['kapitel']).strip() != kapitel:
+            continue
+        known = normalize_text(lesson['thema'])
+        if wanted == known or known.startswith(wanted) or wanted.startswith(known):
+            return lesson['plan']
+    return None
+
+
+if __name__ == "__main__":
+    built = build_index()
+    for key, lesson in built['lessons'].items():
+        print(f"Kapitel {lesson['kapitel']} / {lesson['thema']}: {[step['agent'] for step in lesson['plan']]}")
+    print(f"lesson plan index written to {INDEX_PATH}")
@@ -0,0 +1,200 @@
+'''
+Content-addressed cache for LLM responses.
+The same prompts reach the GPT models again and again (e.g. the getChunks split of a lesson).
+Deterministic calls (temperature 0) are answered from a local SQLite cache keyed by model, temperature,
+messages and bound tools: the split of tools.py, and the agents whose chat model is at temperature 0
+(none of the graph agents by default, they keep the sampling of the default model).
+Entries expire after a TTL and the least recently used ones are evicted above a size limit.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from langchain_core.messages import messages_from_dict, messages_to_dict
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/llm_cache.sqlite")
+# time to live of a cached response (in seconds)
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+# maximum number of cached responses, least recently used ones are evicted first
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+
+
+def make_key(model: str, temperature, messages: list, tools=None) -> str:
+    """
+    Builds the cache key of an LLM call.
+
+    Args:
+        model (str): the model name.
+        temperature (float): the sampling temperature.
+        messages (list): the messages sent, as JSON serializable dicts.
+        tools (list): the tools bound to the model, as sent to the API.
+
+    Returns:
+        str: the sha256 of the call.
+    """
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "messages": messages, "tools": tools or []},
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite backed response cache with TTL, LRU eviction and hit/miss counters.
+    Safe to share between the sessions of a process.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+            """
+        )
+
+    def get(self, key: str):
+        """
+        Returns the cached value for this key, None on a miss or if the entry expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str):
+        """
+        Stores a value and evicts the least recently used entries above max_entries.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, created_at = excluded.created_at, "
+                "last_access = excluded.last_access",
+                (key, value, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the number of cached entries.
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> ResponseCache:
+    """
+    Returns the process-wide response cache, the database is opened on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
+
+
+def _message_fingerprint(message) -> dict:
+    ''' the parts of a message the model sees, without the run/tool call ids that change on every call '''
+    return {
+        "type": message.type,
+        "content": message.content,
+        "name": message.name,
+        "tool_calls": [{"name": call["name"], "args": call["args"]} for call in getattr(message, 'tool_calls', None) or []],
+    }
+
+
+def agent_cache_key(agent, state):
+    """
+    Cache key of an agent built by create_agent/create_tutor_agent (prompt | llm.bind_tools(tools)).
+
+    Returns:
+        str: the key, or None if the call is not deterministic and must not be cached.
+    """
+    prompt, bound_llm = getattr(agent, 'first', None), getattr(agent, 'last', None)
+    chat_model = getattr(bound_llm, 'bound', None)
+    if prompt is None or chat_model is None or getattr(chat_model, 'temperature', None) != 0:
+        return None
+    messages = prompt.invoke(state).to_messages()
+    return make_key(
+        chat_model.model_name,
+        chat_model.temperature,
+        [_message_fingerprint(message) for message in messages],
+        bound_llm.kwargs.get('tools'),
+    )
+
+
+def dump_message(message) -> str:
+    return json.dumps(messages_to_dict([message]), ensure_ascii=False)
+
+
+def load_message(value: str):
+    """
+    Rebuilds a cached message. Its tool calls get new ids: the ToolMessages answering them are matched
+    by id, and the same cached reply can be replayed in several sessions or twice in one conversation.
+    """
+    message = messages_from_dict(json.loads(value))[0]
+    tool_calls = getattr(message, 'tool_calls', None)
+    if not tool_calls:
+        return message
+    new_ids = {call['id']: f"call_{uuid.uuid4().hex[:24]}" for call in tool_calls}
+    raw_calls = message.additional_kwargs.get('tool_calls') or []
+    return message.copy(update={
+        "tool_calls": [{**call, "id": new_ids[call['id']]} for call in tool_calls],
+        "additional_kwargs": {**message.additional_kwargs, **({"tool_calls": [
+            {**call, "id": new_ids.get(call.get('id'), call.get('id'))} for call in raw_calls]} if raw_calls else {})},
+    })
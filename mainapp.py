@@ -1,40 +1,63 @@
 '''
 This file contains the app creation using FastAPI.
-The graph is created in another file and imported here (see graph_creation.py).
+The graph is created in another file and loaded in the background at startup (see graph_creation.py and startup.py).
 All functions are async to avoid problems with client communication.
 See https://fastapi.tiangolo.com for more information.
 '''
 
-# Langchain import
-from langchain_core.messages import (
-    HumanMessage,
-)
-
-# Multi-Agent graph import
-from graph_creation import graph
-
 # FastAPI imports
+import importlib
 import logging
 import os
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import asyncio
 
-from state import message_state
-from tts.tts import setupTTS, speak
+from state import sessions, current_session_id
+from startup import StartupManager, ComponentUnavailable
+from metrics import registry, tool_callbacks, log_event
+from tts.pool import TTSWorkerPool, TTSQueueFull
+from tts.cache import get_audio_cache
+from tts.tts import split_sentences, wav_stream_header
+
+# the multi-agent graph (see graph_creation.py), the retrieval models and the TTS models are loaded in the
+# background once the server is up, see startup.py and /ready
+startup_manager = StartupManager()
 
-app = FastAPI()
+# the Synthesizers are loaded by the pool at startup, one per worker (see tts/pool.py)
+tts_pool = TTSWorkerPool(cache=get_audio_cache())
 
-try:
-    print("[INFO] - Setting Up TTS")
-    synthesizer = setupTTS()
-except Exception as e:
-    print(str(e))
+# queue depths and cache counters are read when /metrics is scraped, the latencies are recorded on the hot path (see metrics.py)
+registry.gauge("ell_sessions", "Active tutoring sessions.", lambda: len(sessions))
+registry.gauge("ell_session_queue_depth", "Items waiting in the session queues, summed over the sessions.",
+               lambda: {("ai_messages",): sum(s.ai_messages.qsize() for s in sessions),
+                        ("user_inputs",): sum(s.user_inputs.qsize() for s in sessions)}, ["queue"])
+registry.gauge("ell_tts_pending", "TTS jobs running or waiting for a worker.", lambda: tts_pool.stats()["pending"])
 
-global_prompts_list =[]
-agent_activation_order = []
+def cache_stats():
+    from llm_cache import get_llm_cache
+    values = {}
+    for name, stats in (("llm", get_llm_cache().stats()), ("audio", tts_pool.cache.stats())):
+        values[(name, "hit")] = stats["hits"] if "hits" in stats else stats["memory_hits"] + stats["disk_hits"]
+        values[(name, "miss")] = stats["misses"]
+    retrieval = startup_manager.get("retrieval")
+    if retrieval is not None:
+        stats = retrieval.query_cache.stats()
+        values[("query", "hit")] = stats["exact_hits"] + stats["near_hits"]
+        values[("query", "miss")] = stats["misses"]
+        values[("query", "metadata")] = stats["metadata_answers"]
+    return values
+
+registry.gauge("ell_cache_lookups", "Lookups of the LLM response, retrieval query and audio caches.", cache_stats, ["cache", "result"])
+registry.gauge("ell_component_ready", "1 once a startup component is loaded (see /ready).",
+               lambda: {(name,): info["status"] == "ready" for name, info in startup_manager.status()["components"].items()},
+               ["component"])
+
+# how long a request waits for the graph while the server is starting (in seconds)
+GRAPH_STARTUP_TIMEOUT = float(os.getenv("GRAPH_STARTUP_TIMEOUT", "60"))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -43,58 +66,189 @@ logging.basicConfig(level=logging.INFO,
 # Create a logger object
 logger = logging.getLogger(__name__)
 
+def log_retrieval_metrics(metrics):
+    logger.info(f"retrieval {metrics['component']} loaded in {metrics['load_time_s']}s "
+                f"(rss: {metrics['rss_mb']} MB, delta: {metrics['rss_delta_mb']} MB)")
+
+async def load_graph():
+    # langchain, langgraph and the agents are imported in a thread, the event loop keeps serving /health
+    graph_module = await asyncio.to_thread(importlib.import_module, 'graph_creation')
+    # the tokenizer counting the prompts (see context.py) may be downloaded, never from inside a node
+    from context import load_encoder
+    await asyncio.to_thread(load_encoder)
+    from checkpointing import configure_checkpointer
+    await configure_checkpointer(graph_module.memory)
+    app.state.checkpoint_pruning = asyncio.create_task(prune_old_checkpoints(graph_module.memory))
+    return graph_module
+
+def load_retrieval():
+    from retrieval import get_retrieval_service
+    service = get_retrieval_service()
+    service.add_metrics_hook(log_retrieval_metrics)
+    service.warmup()
+    return service
+
+def load_tts():
+    tts_pool.start()
+    logger.info(f"TTS ready with {tts_pool.workers} worker(s)")
+    return tts_pool
+
+startup_manager.register("graph", load_graph)
+startup_manager.register("retrieval", load_retrieval, required=False)
+startup_manager.register("tts", load_tts, required=False)
+
+async def get_graph_module():
+    try:
+        return await startup_manager.wait("graph", timeout=GRAPH_STARTUP_TIMEOUT)
+    except ComponentUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+# how often idle sessions are looked for (in seconds)
+SESSION_EVICTION_INTERVAL = 60
+
+async def evict_idle_sessions():
+    while True:
+        await asyncio.sleep(SESSION_EVICTION_INTERVAL)
+        evicted = sessions.evict_idle()
+        if evicted:
+            logger.info(f"evicted {len(evicted)} idle session(s), {len(sessions)} still active")
+
+# how often old checkpoints are pruned (in seconds)
+CHECKPOINT_PRUNE_INTERVAL = 10 * 60
+
+async def prune_old_checkpoints(memory):
+    from checkpointing import prune_checkpoints
+    while True:
+        await asyncio.sleep(CHECKPOINT_PRUNE_INTERVAL)
+        try:
+            deleted = await prune_checkpoints(memory)
+            if deleted:
+                logger.info(f"pruned {deleted} old checkpoint(s)")
+        except Exception as e:
+            logger.error(f"Could not prune checkpoints: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # nothing heavy is loaded before the server accepts requests
+    startup_manager.start()
+    app.state.session_eviction = asyncio.create_task(evict_idle_sessions())
+    yield
+    app.state.session_eviction.cancel()
+    if hasattr(app.state, "checkpoint_pruning"):
+        app.state.checkpoint_pruning.cancel()
+    await startup_manager.stop()
+    graph_module = startup_manager.get("graph")
+    if graph_module is not None:
+        await graph_module.memory.conn.close()
+    tts_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 class ConversationRequest(BaseModel):
     startBool: bool
     userID: str
 
+class ResumeRequest(BaseModel):
+    sessionID: str
+    userID: str = None
+
 class UserInputRequest(BaseModel):
     content: str
+    sessionID: str
 
 class AcknowledgmentRequest(BaseModel):
     ack: bool
+    sessionID: str
     
 class MessageRequest(BaseModel):
     message: str
 
-async def continue_graph_execution(messages):
-    config = {"configurable": {"thread_id": "1"}, "recursion_limit": 1000}
+def resolve_session(session_id: str):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired session: {session_id}")
+    return session
+
+async def continue_graph_execution(messages, session_id: str):
+    ''' run the graph for a session, messages=None resumes it from its last checkpoint '''
+    # every node, router and tool of this run resolves its MessageState through this id
+    current_session_id.set(session_id)
+    # the callbacks time every tool call of the run (see metrics.py)
+    config = {"configurable": {"thread_id": session_id}, "recursion_limit": 1000, "callbacks": tool_callbacks()}
+    graph_input = None if messages is None else {"messages": messages}
+    graph = (await get_graph_module()).graph
+    log_event("graph_start", resumed=messages is None)
     try:
-        async for s in graph.astream({"messages": messages}, config=config):
+        async for s in graph.astream(graph_input, config=config):
             if "__end__" not in s:
                 print(s)
                 print("----")
                 # Update the shared state with the current content and agent name
                 await asyncio.sleep(0)  # Yield control to the event loop
+        log_event("graph_end")
     except KeyError as e:
         logger.error(f"KeyError encountered: {e}")
         logger.debug(f"Messages: {messages}")
         raise
+    except asyncio.CancelledError:
+        logger.info(f"Graph execution cancelled for session {session_id}")
+        raise
     except Exception as e:
         logger.error(f"Exception encountered: {e}")
         raise
 
 
 @app.post("/startConversation")
-async def begin_graph_stream(request: ConversationRequest, background_tasks: BackgroundTasks):
+async def begin_graph_stream(request: ConversationRequest):
     if request.startBool:
+        # text chat only needs the graph, it does not wait for the retrieval and TTS models
+        await get_graph_module()
+        from langchain_core.messages import HumanMessage  # already imported by the graph
         try:
             messages = [
                 HumanMessage(content=f"Communicator, the user ID is {request.userID}. Please start with your task.")
             ]
-            background_tasks.add_task(continue_graph_execution, messages)
-            return JSONResponse(content={"message": "Conversation started"}, status_code=200)
+            session = sessions.create(user_id=request.userID)
+            # the task is kept on the session so it can be cancelled when the session is evicted
+            session.task = asyncio.create_task(continue_graph_execution(messages, session.session_id))
+            return JSONResponse(content={"message": "Conversation started", "sessionID": session.session_id}, status_code=200)
         except Exception as e:
             return JSONResponse(content={"error": str(e)}, status_code=500)
     else:
         raise HTTPException(status_code=400, detail="startBool must be true")
 
+@app.post("/resumeConversation")
+async def resume_conversation(request: ResumeRequest):
+    '''
+    Continues a learner's graph from its last checkpoint, e.g. after a server restart.
+    The client then reconnects to the session with the same sessionID.
+    '''
+    session = sessions.get(request.sessionID)
+    if session is not None and session.task is not None and not session.task.done():
+        return JSONResponse(content={"message": "Conversation already running", "sessionID": request.sessionID}, status_code=200)
+
+    graph = (await get_graph_module()).graph
+    snapshot = await graph.aget_state({"configurable": {"thread_id": request.sessionID}})
+    if not snapshot.values:
+        raise HTTPException(status_code=404, detail=f"No saved conversation for session: {request.sessionID}")
+    if not snapshot.next:
+        raise HTTPException(status_code=409, detail="This conversation is already finished")
+
+    if session is None:
+        session = sessions.create(user_id=request.userID, session_id=request.sessionID)
+    # the lesson steps left when the checkpoint was saved
+    session.lessons.load(snapshot.values.get("lesson_plan") or [])
+    session.task = asyncio.create_task(continue_graph_execution(None, session.session_id))
+    return JSONResponse(content={"message": "Conversation resumed", "sessionID": session.session_id}, status_code=200)
+
 @app.get("/getAIMessage")
-async def get_ai_message():
+async def get_ai_message(sessionID: str):
     print('entering get function...')
+    message_state = resolve_session(sessionID)
     message_data = await message_state.wait_for_update()
-    response_payload = {
+    response_payload = {  # token deltas are only sent over the websocket
         "agent_name": message_data["agent_name"],
         "content": message_data["content"]
     }
@@ -103,14 +257,18 @@ async def get_ai_message():
 
 @app.post("/userInput")
 async def receive_user_input(request: UserInputRequest):
+    message_state = resolve_session(request.sessionID)
     try:
         message_state.update_user_input(request.content)
         return JSONResponse(content={"message": "User input received"}, status_code=200)
+    except asyncio.QueueFull:
+        return JSONResponse(content={"error": "Too many pending inputs for this session"}, status_code=429)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 @app.post("/acknowledgeMessage")
 async def acknowledge_message(request: AcknowledgmentRequest):
+    message_state = resolve_session(request.sessionID)
     try:
         if request.ack:
             message_state.acknowledge_message()
@@ -120,18 +278,114 @@ async def acknowledge_message(request: AcknowledgmentRequest):
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
     
+@app.websocket("/ws/{sessionID}")
+async def conversation_socket(websocket: WebSocket, sessionID: str):
+    '''
+    Single connection per session replacing the /getAIMessage, /acknowledgeMessage and /userInput round trips.
+    Server -> client: {"type": "message" | "delta" | "discard", "agent_name": ..., "content": ...}
+    "delta" carries the tokens of a reply while it is generated, "message" the complete reply,
+    "discard" drops the deltas of a reply that ended with a tool call instead.
+    Client -> server: {"type": "ack"} or {"type": "user_input", "content": ...}
+    The MessageState handshake is unchanged: the routers still wait for the ack, then for the user input.
+    '''
+    message_state = sessions.get(sessionID)
+    if message_state is None:
+        await websocket.close(code=4404, reason="Unknown or expired session")
+        return
+    await websocket.accept()
+
+    async def push_messages():
+        while True:
+            message_data = await message_state.wait_for_update(include_deltas=True)
+            await websocket.send_json(message_data)
+
+    sender = asyncio.create_task(push_messages())
+    try:
+        while True:
+            data = await websocket.receive_json()
+            if data.get("type") == "ack":
+                message_state.acknowledge_message()
+            elif data.get("type") == "user_input":
+                try:
+                    message_state.update_user_input(data.get("content", ""))
+                except asyncio.QueueFull:
+                    await websocket.send_json({"type": "error", "content": "Too many pending inputs for this session"})
+            else:
+                await websocket.send_json({"type": "error", "content": f"Unknown message type: {data.get('type')}"})
+    except WebSocketDisconnect:
+        logger.info(f"websocket closed for session {sessionID}")
+    finally:
+        sender.cancel()
+
 @app.post("/tts")
 async def text_to_speech(request: MessageRequest):
     try:
-        output_file = "output.wav"
-        speak(synthesizer=synthesizer, text=request.message)
-        if os.path.exists(output_file):
-            return FileResponse(output_file, media_type='audio/wav', filename=output_file)
-        else:
-            raise HTTPException(status_code=500, detail="Audio file not found")
+        # synthesized in a worker thread, the audio is kept in memory for this request only
+        audio = await tts_pool.synthesize(request.message)
+    except TTSQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return Response(content=audio, media_type='audio/wav',
+                    headers={"Content-Disposition": 'attachment; filename="output.wav"'})
+
+@app.post("/tts/stream")
+async def text_to_speech_stream(request: MessageRequest):
+    '''
+    Streams the speech sentence by sentence as a chunked WAV, playback can start after the first sentence.
+    The next sentence is synthesized while the current one is being sent.
+    '''
+    sentences = split_sentences(request.message)
+    if not sentences:
+        raise HTTPException(status_code=400, detail="Nothing to synthesize")
+    try:
+        # the first sentence is synthesized before answering, so a full pool can still be reported with a 503
+        first_chunk = await tts_pool.synthesize_pcm(sentences[0])
+    except TTSQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def audio_chunks():
+        next_chunk = asyncio.ensure_future(tts_pool.synthesize_pcm(sentences[1])) if len(sentences) > 1 else None
+        try:
+            yield wav_stream_header()
+            yield first_chunk
+            for index in range(1, len(sentences)):
+                next_chunk = next_chunk or asyncio.ensure_future(tts_pool.synthesize_pcm(sentences[index]))
+                chunk = await next_chunk
+                # start the following sentence before sending this one
+                next_chunk = (asyncio.ensure_future(tts_pool.synthesize_pcm(sentences[index + 1]))
+                              if index + 1 < len(sentences) else None)
+                yield chunk
+        except Exception as e:
+            logger.error(f"TTS stream stopped: {e}")
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+
+    return StreamingResponse(audio_chunks(), media_type='audio/wav')
+
+@app.get("/tts/stats")
+async def text_to_speech_stats():
+    return JSONResponse(content=tts_pool.stats(), status_code=200)
     
+@app.get("/metrics")
+async def metrics():
+    ''' per node, tool and LLM call latencies, token usage, cache hits and queue depths, in the Prometheus text format '''
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    ''' liveness: answers as soon as the server is up, even while the models are loading '''
+    return JSONResponse(content={"status": "ok"}, status_code=200)
+
+@app.get("/ready")
+async def ready():
+    ''' readiness per component (graph, retrieval, tts), 503 until the required ones are loaded '''
+    status = startup_manager.status()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
 @app.get("/")
 async def read_index():
     return FileResponse('static/index.html')
\ No newline at end of file
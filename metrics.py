@@ -0,0 +1,309 @@
+'''
+Instrumentation of the hot path, without LangSmith.
+A small in-process registry of counters, gauges and histograms, rendered in the Prometheus text format
+by the /metrics endpoint, plus one JSON log line per timed event carrying the session id.
+Recorded: the latency of each graph node, tool and LLM call, token usage, LLM/retrieval/TTS cache hits,
+TTS synthesis, the ack and input waits, and (at scrape time) the queue depths.
+'''
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from state import current_session_id
+
+# one JSON object per line on stderr, set METRICS_JSON_LOGS=0 to turn them off
+METRICS_JSON_LOGS = os.getenv("METRICS_JSON_LOGS", "1") == "1"
+
+# in seconds, from a cached answer to a long LLM reply or a paragraph of speech
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# waits on the learner (ack, next input) last much longer
+WAIT_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# number of queries embedded in one forward pass (see embedding_batching.py)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# time a query waits for its batch, a few milliseconds unless a batch is already running
+QUEUE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+event_logger = logging.getLogger("ell.events")
+if METRICS_JSON_LOGS and not event_logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    event_logger.addHandler(_handler)
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+
+
+def log_event(event: str, **fields):
+    """
+    Writes a structured JSON log line with the id of the current session.
+    """
+    if not METRICS_JSON_LOGS:
+        return
+    record = {"ts": round(time.time(), 3), "event": event, "session_id": current_session_id.get(), **fields}
+    event_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Gauge read at scrape time: the callback returns a number, or a dict label values tuple -> number.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback, labels=()):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def render(self) -> list:
+        try:
+            values = self.callback()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {e}"]
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.label_names, key)} {float(value)}"
+                for key, value in values.items() if value is not None]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            values = {key: list(data) for key, data in self._values.items()}
+        lines = []
+        names = self.label_names + ("le",)
+        for key, data in values.items():
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {data[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    The metrics of the process, rendered by /metrics.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labels=()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, callback, labels=()) -> Gauge:
+        ''' registers (or replaces) a gauge read at scrape time '''
+        gauge = Gauge(name, help_text, callback, labels)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+NODE_SECONDS = registry.histogram("ell_graph_node_seconds", "Duration of a graph node run.", ["node"])
+NODE_ERRORS = registry.counter("ell_graph_node_errors_total", "Graph node runs that raised.", ["node"])
+TOOL_SECONDS = registry.histogram("ell_tool_seconds", "Duration of a tool call.", ["tool"])
+LLM_SECONDS = registry.histogram("ell_llm_request_seconds", "Duration of an LLM call made by an agent.", ["agent", "cached"])
+LLM_TOKENS = registry.counter("ell_llm_tokens_total", "Tokens used by the agents (prompt tokens are counted before the call).", ["agent", "kind"])
+LLM_CACHE = registry.counter("ell_llm_cache_lookups_total", "Response cache lookups of the deterministic agents.", ["agent", "result"])
+LESSON_PREFETCHES = registry.counter("ell_lesson_prefetch_total", "Lessons prepared ahead of getChunks, by outcome.", ["result"])
+RETRIEVAL_SECONDS = registry.histogram("ell_retrieval_seconds", "Duration of a retrieval query, by how it was answered.", ["path"])
+EMBEDDING_BATCH_QUERIES = registry.histogram("ell_embedding_batch_queries", "Queries embedded in one batch.", (), BATCH_SIZE_BUCKETS)
+EMBEDDING_QUEUE_SECONDS = registry.histogram("ell_embedding_queue_wait_seconds", "Time a query waited before its batch was embedded.", (), QUEUE_BUCKETS)
+TTS_SECONDS = registry.histogram("ell_tts_seconds", "Duration of a TTS job on a worker.", ["job"])
+WAIT_SECONDS = registry.histogram("ell_session_wait_seconds", "Time a session waited on the learner.", ["kind"], WAIT_BUCKETS)
+
+
+def timed_node(func, name: str):
+    """
+    Wraps a graph node (an agent node or a ToolNode) to record its duration and errors.
+
+    Args:
+        func: the node, a (async) function or a runnable such as ToolNode.
+        name (str): the node name in the graph.
+
+    Returns:
+        the async node to add to the graph.
+    """
+    import inspect
+
+    if hasattr(func, "ainvoke"):
+        async def call(state, config):
+            return await func.ainvoke(state, config)
+    elif "config" in inspect.signature(func).parameters:
+        async def call(state, config):
+            return await func(state, config=config)
+    else:
+        async def call(state, config):
+            return await func(state)
+
+    async def node(state, config):
+        start = time.perf_counter()
+        try:
+            return await call(state, config)
+        except Exception as e:
+            NODE_ERRORS.inc(node=name)
+            log_event("node_error", node=name, error=str(e))
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            NODE_SECONDS.observe(duration, node=name)
+            log_event("node", node=name, duration_ms=round(duration * 1000, 1))
+
+    node.__name__ = name
+    return node
+
+
+async def timed_wait(kind: str, awaitable):
+    """
+    Awaits a wait on the learner (kind "ack" or "input") and records how long the session waited.
+    """
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        duration = time.perf_counter() - start
+        WAIT_SECONDS.observe(duration, kind=kind)
+        log_event("wait", kind=kind, duration_ms=round(duration * 1000, 1))
+
+
+def record_llm_call(agent: str, duration: float, cached: bool, prompt_tokens: int, message):
+    """
+    Records one LLM call of an agent. The completion tokens come from the usage reported by the API,
+    or are estimated from the reply when it is not reported (streaming, cache hits).
+    """
+    LLM_SECONDS.observe(duration, agent=agent, cached=str(cached).lower())
+    usage = getattr(message, "usage_metadata", None) or {}
+    prompt = usage.get("input_tokens", prompt_tokens)
+    completion = usage.get("output_tokens")
+    if completion is None:
+        completion = max(1, len(message.content) // 4) if isinstance(message.content, str) and message.content else 0
+    if not cached:
+        LLM_TOKENS.inc(prompt, agent=agent, kind="prompt")
+        LLM_TOKENS.inc(completion, agent=agent, kind="completion")
+    log_event("llm", agent=agent, duration_ms=round(duration * 1000, 1), cached=cached,
+              prompt_tokens=prompt, completion_tokens=completion)
+
+
+def _tool_callbacks():
+    ''' callback handler timing every tool call of a graph run, tools run in worker threads '''
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class ToolTimingHandler(BaseCallbackHandler):
+        def __init__(self):
+            self._starts = {}
+
+        def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+            self._starts[run_id] = ((serialized or {}).get("name") or kwargs.get("name") or "tool", time.perf_counter())
+
+        def _end(self, run_id, error=None):
+            name, start = self._starts.pop(run_id, ("tool", None))
+            if start is None:
+                return
+            duration = time.perf_counter() - start
+            TOOL_SECONDS.observe(duration, tool=name)
+            log_event("tool", tool=name, duration_ms=round(duration * 1000, 1), error=error)
+
+        def on_tool_end(self, output, *, run_id, **kwargs):
+            self._end(run_id)
+
+        def on_tool_error(self, error, *, run_id, **kwargs):
+            self._end(run_id, str(error))
+
+    return ToolTimingHandler()
+
+
+_tool_handler = None
+
+
+def tool_callbacks() -> list:
+    """
+    The callbacks to pass in the graph config so every tool call is timed.
+    """
+    global _tool_handler
+    if _tool_handler is None:
+        _tool_handler = _tool_callbacks()
+    return [_tool_handler]
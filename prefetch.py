@@ -0,0 +1,162 @@
+'''
+Speculative preparation of the lesson the communicator is negotiating.
+The communicator spends several turns agreeing on a Kapitel/Thema with the learner before go_orchestrator,
+and getChunks only starts the retrieval and the split of the lesson per agent after that. Every
+recommendation of the communicator is now scanned for Kapitel/Thema candidates (see communicator_router)
+and their lesson plans are prepared in the background while the learner reads and answers.
+getChunks takes the plan of the chosen lesson when it is ready (or waits for the running preparation),
+the candidates that were not chosen are cancelled.
+A lesson of the lesson plan index costs nothing to prepare. Any other lesson costs the retrieval and the
+LLM split that getChunks runs anyway when it is chosen, and is cancelled as soon as a recommendation
+no longer mentions it.
+'''
+
+import asyncio
+import os
+import re
+
+from lesson_plan import load_index, normalize_text, parse_query
+from metrics import LESSON_PREFETCHES
+
+# set LESSON_PREFETCH=0 to only prepare the lesson in getChunks
+LESSON_PREFETCH = os.getenv("LESSON_PREFETCH", "1") == "1"
+# maximum number of lessons prepared at once for one session
+LESSON_PREFETCH_MAX_CANDIDATES = int(os.getenv("LESSON_PREFETCH_MAX_CANDIDATES", "2"))
+
+_KAPITEL_PATTERN = re.compile(r'kapitel\s*:?\s*(\d+)', re.IGNORECASE)
+# "Kapitel: 2 Thema: Wéi geet et?" as the communicator writes the query it sends to the orchestrator. The thema is
+# either quoted, or ends with its punctuation ("?", "!", "."), before "oder"/"or", a comma or the next Kapitel
+_QUERY_PATTERN = re.compile(
+    r'kapitel\s*:?\s*(\d+)\s*[,;\n]?\s*thema\s*:?\s*'
+    r'(?:["„“«»]([^"„“”«»\n]+)["“”«»]'
+    r'|([^\n"„“”«»]+?)(?:(?<=[?!.])(?=\s)|(?=\s+(?:oder|or)\b|\s*[,;]|\s*\bkapitel\b|\s*$)))',
+    re.IGNORECASE | re.MULTILINE)
+
+
+def lesson_id(query: str):
+    ''' (kapitel, normalized thema) of a query, None if it does not name both '''
+    kapitel, thema = parse_query(query)
+    if kapitel is None or not thema or len(normalize_text(thema)) < 3:
+        return None
+    return kapitel, normalize_text(thema)
+
+
+def same_lesson(a: tuple, b: tuple) -> bool:
+    ''' compares two lesson ids like lookup_lesson_plan, a shortened thema matches the full one '''
+    return a[0] == b[0] and (a[1] == b[1] or a[1].startswith(b[1]) or b[1].startswith(a[1]))
+
+
+def candidate_queries(text: str, max_candidates: int = LESSON_PREFETCH_MAX_CANDIDATES) -> list:
+    """
+    Finds the lessons a communicator message talks about.
+    The lessons of the index are recognized from their Kapitel and the first word of their Thema
+    ("Kapitel 1, Moien" is enough), other lessons only from an explicit "Kapitel: ... Thema: ...".
+
+    Args:
+        text (str): the communicator message.
+        max_candidates (int): maximum number of queries returned.
+
+    Returns:
+        list: "Kapitel: ... Thema: ..." queries, in the order they appear in the message.
+    """
+    kapitels = {match.group(1): match.start() for match in reversed(list(_KAPITEL_PATTERN.finditer(text)))}
+    if not kapitels:
+        return []
+    words = f" {normalize_text(text)} "
+    found = []  # (position, query)
+    for lesson in load_index().values():
+        kapitel = str(lesson['kapitel']).strip()
+        thema = normalize_text(lesson['thema'])
+        if kapitel in kapitels and thema and (f" {thema} " in words or f" {thema.split()[0]} " in words):
+            found.append((kapitels[kapitel], f"Kapitel: {kapitel} Thema: {lesson['thema']}"))
+    recognized = {position for position, _ in found}
+    for match in _QUERY_PATTERN.finditer(text):
+        if match.start() in recognized:  # this mention is already a lesson of the index
+            continue
+        query = f"Kapitel: {match.group(1)} Thema: {(match.group(2) or match.group(3)).strip().rstrip('.')}"
+        wanted = lesson_id(query)
+        if wanted and not any(same_lesson(wanted, lesson_id(known)) for _, known in found):
+            found.append((match.start(), query))
+    return [query for _, query in sorted(found)][:max_candidates]
+
+
+class LessonPrefetcher:
+    """
+    The lessons being prepared ahead of getChunks for one session (MessageState.prefetch).
+    """
+
+    def __init__(self, enabled: bool = LESSON_PREFETCH, max_candidates: int = LESSON_PREFETCH_MAX_CANDIDATES):
+        """
+        Args:
+            enabled (bool): False turns observe into a no-op, take then always returns None.
+            max_candidates (int): maximum number of lessons prepared at once.
+        """
+        self.enabled = enabled
+        self.max_candidates = max_candidates
+        self._tasks = {}  # lesson id -> (query, task returning the plan)
+
+    def observe(self, text: str, prepare):
+        """
+        Starts preparing the lessons named in a communicator message, and cancels the ones it no longer names.
+        A message without any candidate changes nothing.
+
+        Args:
+            text (str): the communicator message.
+            prepare (coroutine function): builds the plan of a query, tools.prepare_lesson.
+
+        Returns:
+            list: the queries being prepared after this message.
+        """
+        if not self.enabled:
+            return []
+        candidates = {}
+        for query in candidate_queries(text, self.max_candidates):
+            candidates.setdefault(lesson_id(query), query)
+        if not candidates:
+            return [query for query, _ in self._tasks.values()]
+        self.cancel(keep=[known for known in self._tasks if any(same_lesson(known, key) for key in candidates)])
+        for key, query in candidates.items():
+            if not any(same_lesson(key, known) for known in self._tasks):
+                task = asyncio.ensure_future(prepare(query))
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())  # a failure is reported by take
+                self._tasks[key] = (query, task)
+                LESSON_PREFETCHES.inc(result="started")
+                print(f'[INFO] - preparing lesson ahead of getChunks: {query}')
+        return [query for query, _ in self._tasks.values()]
+
+    async def take(self, query: str):
+        """
+        Returns the plan prepared for the lesson of a query (waiting for it if it is still running)
+        and cancels the other candidates, the lesson is chosen.
+
+        Returns:
+            list: the plan, None if this lesson was not prepared or its preparation failed.
+        """
+        wanted = lesson_id(query)
+        key = next((key for key in self._tasks if wanted and same_lesson(wanted, key)), None)
+        self.cancel(keep=[key] if key else ())
+        if key is None:
+            if self.enabled:
+                LESSON_PREFETCHES.inc(result="miss")
+            return None
+        _, task = self._tasks.pop(key)
+        try:
+            plan = await task
+        except Exception as e:
+            print(f'[WARNING] - the lesson prepared for {query} failed, preparing it again: {e}')
+            plan = None
+        LESSON_PREFETCHES.inc(result="hit" if plan is not None else "failed")
+        return plan
+
+    def cancel(self, keep=()):
+        ''' cancels the preparations of every lesson except the ones whose id is in keep '''
+        for key in list(self._tasks):
+            if key in keep:
+                continue
+            _, task = self._tasks.pop(key)
+            if not task.done():
+                task.cancel()
+                LESSON_PREFETCHES.inc(result="cancelled")
+
+    def __len__(self):
+        return len(self._tasks)
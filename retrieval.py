@@ -0,0 +1,356 @@
+'''
+Retrieval service used by the orchestrator tools.
+The embedding model and the Chroma vector store are heavy to build (several seconds and hundreds of MB),
+so they are loaded once per process and shared by every session instead of being rebuilt on each getChunks call.
+The service is warmed up when FastAPI starts (see mainapp.py).
+'''
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_batching import QueryEmbeddingBatcher, embed_queries
+from embeddings import EMBEDDING_MODEL_NAME, create_embeddings
+from hybrid_search import HYBRID_CANDIDATES, HybridIndex, reciprocal_rank_fusion
+from metrics import RETRIEVAL_SECONDS
+
+PERSIST_DIRECTORY = "data/bge_test_"
+DEFAULT_TOP_K = 3
+# number of queries kept in the retrieval cache
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+# cosine similarity above which two queries share their results, empty to only cache exact queries
+NEAR_DUPLICATE_THRESHOLD = os.getenv("QUERY_CACHE_NEAR_DUPLICATE_THRESHOLD", "0.97")
+# set INGEST_ON_STARTUP=1 to update the store and the lesson plan index from the content file at startup,
+# by default they are updated with python ingest.py when the content changes (the startup only checks the store)
+INGEST_ON_STARTUP = os.getenv("INGEST_ON_STARTUP", "0") == "1"
+
+
+def _current_rss_mb():
+    ''' resident memory of the process in MB, None if psutil is not available '''
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of retrieval results.
+    Exact hits are keyed by the normalized query string, near-duplicate hits compare the
+    query embedding with the embeddings of the cached queries.
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_SIZE, near_duplicate_threshold: float = None):
+        """
+        Args:
+            max_entries (int): maximum number of cached queries.
+            near_duplicate_threshold (float): minimum cosine similarity for a near-duplicate hit, None to disable it.
+        """
+        self.max_entries = max_entries
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.metadata_answers = 0  # queries answered from the chunk metadata, neither a hit nor a search
+        self._entries = OrderedDict()  # (normalized query, k) -> (docs, embedding)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Empties the cache, the vector store it was filled from changed.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, query: str, k: int):
+        with self._lock:
+            key = (normalize_query(query), k)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return self._entries[key][0]
+            return None
+
+    def get_similar(self, embedding, k: int):
+        """
+        Returns the results of the most similar cached query if it is above the threshold.
+        The embeddings are normalized, so the dot product is the cosine similarity.
+        """
+        with self._lock:
+            candidates = [(key, entry) for key, entry in self._entries.items()
+                          if key[1] == k and entry[1] is not None]
+            if self.near_duplicate_threshold is None or not candidates:
+                return None
+            similarities = np.stack([entry[1] for _, entry in candidates]) @ np.asarray(embedding)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.near_duplicate_threshold:
+                return None
+            key, (docs, _) = candidates[best]
+            self._entries.move_to_end(key)
+            self.near_hits += 1
+            return docs
+
+    def put(self, query: str, k: int, docs, embedding=None, from_metadata: bool = False):
+        with self._lock:
+            if from_metadata:
+                self.metadata_answers += 1
+            else:
+                self.misses += 1
+            vector = None if embedding is None else np.asarray(embedding, dtype=np.float32)
+            self._entries[(normalize_query(query), k)] = (docs, vector)
+            self._entries.move_to_end((normalize_query(query), k))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.near_hits + self.misses + self.metadata_answers
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "metadata_answers": self.metadata_answers,
+            "hit_rate": (self.exact_hits + self.near_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+class RetrievalService:
+    """
+    Holds the process-wide embedding model and vector store.
+    Loading is lazy and guarded by a lock so concurrent sessions only trigger one load.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, persist_directory: str = PERSIST_DIRECTORY):
+        """
+        Args:
+            model_name (str): name of the HuggingFace bge model used to embed the queries (the backend is set in embeddings.py).
+            persist_directory (str): directory of the persisted Chroma store.
+        """
+        self.model_name = model_name
+        self.persist_directory = persist_directory
+        self._lock = threading.Lock()
+        self._embeddings = None
+        self._vectordb = None
+        self._index = None  # HybridIndex of the chunks, see search_index
+        self._metrics_hooks = []
+        self.query_batcher = QueryEmbeddingBatcher(self._embed_queries)
+        self.query_cache = QueryCache(
+            near_duplicate_threshold=float(NEAR_DUPLICATE_THRESHOLD) if NEAR_DUPLICATE_THRESHOLD else None
+        )
+
+    def add_metrics_hook(self, hook):
+        """
+        Registers a callable that receives a dict with the load metrics of each component.
+
+        Args:
+            hook (callable): called as hook({"component": ..., "load_time_s": ..., "rss_mb": ..., "rss_delta_mb": ...})
+        """
+        self._metrics_hooks.append(hook)
+
+    def _report(self, component: str, load_time: float, rss_before, rss_after):
+        metrics = {
+            "component": component,
+            "load_time_s": round(load_time, 3),
+            "rss_mb": None if rss_after is None else round(rss_after, 1),
+            "rss_delta_mb": None if rss_before is None or rss_after is None else round(rss_after - rss_before, 1),
+        }
+        for hook in self._metrics_hooks:
+            try:
+                hook(metrics)
+            except Exception as e:  # a broken hook should never break retrieval
+                print(f'[WARNING] - retrieval metrics hook failed: {e}')
+
+    def _load(self):
+        ''' build the embedder and the vector store, must be called with the lock held '''
+        # heavy imports are kept here so importing this module stays cheap
+        from langchain_community.vectorstores import Chroma
+
+        rss_before = _current_rss_mb()
+        start = time.perf_counter()
+        embeddings = create_embeddings(model_name=self.model_name)
+        rss_mid = _current_rss_mb()
+        self._report("embeddings", time.perf_counter() - start, rss_before, rss_mid)
+
+        start = time.perf_counter()
+        vectordb = Chroma(persist_directory=self.persist_directory, embedding_function=embeddings)
+        self._report("vectorstore", time.perf_counter() - start, rss_mid, _current_rss_mb())
+
+        self._embeddings = embeddings
+        self._vectordb = vectordb
+
+    def _ensure_loaded(self):
+        if self._vectordb is not None:
+            return
+        with self._lock:
+            if self._vectordb is None:  # another session may have loaded it while we waited
+                self._load()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._vectordb is not None
+
+    @property
+    def embeddings(self):
+        self._ensure_loaded()
+        return self._embeddings
+
+    @property
+    def vectordb(self):
+        self._ensure_loaded()
+        return self._vectordb
+
+    def warmup(self):
+        """
+        Loads the embedder and the vector store and runs one query so the first learner does not pay for it.
+        """
+        self._ensure_loaded()
+        self.sync_store()
+        self._embeddings.embed_query("Kapitel: 1 Thema: Moien")
+
+    def sync_store(self, ingest_on_startup: bool = INGEST_ON_STARTUP) -> list:
+        """
+        Checks that the metadata stage of the search resolves the lessons of the content file, and warns
+        if it resolves none: it only answers from chunks that carry their kapitel/thema, which a store not
+        built by ingest.py does not have. With ingest_on_startup the store and the lesson plan index are
+        first brought up to date with the content file (see ingest.py), with the shared embedding model.
+
+        Args:
+            ingest_on_startup (bool): True updates the store and the lesson plan index before the check.
+
+        Returns:
+            list: the lesson queries resolved from the chunk metadata.
+        """
+        from ingest import check_metadata, ingest, refresh_lesson_plans  # not at the top: ingest.py imports this module
+
+        if ingest_on_startup:
+            report = ingest(persist_directory=self.persist_directory, model_name=self.model_name, embeddings=self._embeddings)
+            if report["added"] or report["deleted"]:
+                self.invalidate_store()
+                print(f"[INFO] - vector store updated from the content file: {report}")
+            if refresh_lesson_plans():
+                print("[INFO] - lesson plan index rebuilt from the content file")
+        resolved, lessons = check_metadata(self.search_index())
+        if lessons and not resolved:
+            print(f"[WARNING] - no lesson is resolved from the chunk metadata of {self.persist_directory}, "
+                  f"every query will be embedded: update the store with python ingest.py")
+        return resolved
+
+    def _lookup(self, query: str, k: int):
+        ''' the steps that need no query embedding, returns ((docs, path) or None, the search index) '''
+        docs = self.query_cache.get(query, k)
+        if docs is not None:
+            return (docs, "cache"), None
+
+        # a query naming a known Kapitel/Thema is answered from the chunk metadata, without embedding it
+        index = self.search_index()
+        lesson = index.match_lesson(query)
+        if lesson:
+            docs = [self._document(index, i) for i in lesson[:k]]
+            self.query_cache.put(query, k, docs, from_metadata=True)
+            return (docs, "metadata"), index
+        return None, index
+
+    def _search(self, index: HybridIndex, query: str, embedding, k: int):
+        ''' the steps that use the query embedding, returns (docs, path) '''
+        if self.query_cache.near_duplicate_threshold is not None:
+            docs = self.query_cache.get_similar(embedding, k)
+            if docs is not None:
+                return docs, "similar_cache"
+        docs = self._hybrid_search(index, query, embedding, k)
+        self.query_cache.put(query, k, docs, embedding)
+        return docs, "hybrid"
+
+    def invalidate_store(self):
+        """
+        Takes an update of the persisted store into account: the query cache is emptied and the search
+        index is rebuilt on the next query. sync_store calls it after updating the store, the app must
+        be restarted after python ingest.py changed the store of a running server.
+        """
+        with self._lock:
+            self._index = None
+        self.query_cache.clear()
+
+    def search_index(self) -> HybridIndex:
+        """
+        The metadata and BM25 indexes of the chunks, built on first use and after invalidate_store.
+        """
+        index = self._index
+        if index is None:
+            vectordb = self.vectordb  # loads the store first, _ensure_loaded takes the lock too
+            with self._lock:
+                if self._index is None:
+                    self._index = HybridIndex.from_vectordb(vectordb)
+                index = self._index
+        return index
+
+    @staticmethod
+    def _document(index: HybridIndex, i: int):
+        from langchain_core.documents import Document
+        return Document(page_content=index.documents[i], metadata=index.metadatas[i])
+
+    def _hybrid_search(self, index: HybridIndex, query: str, embedding, k: int) -> list:
+        ''' BM25 and vector search restricted to the Kapitel of the query (if any), fused with RRF '''
+        candidates, where = index.kapitel_filter(query)
+        lexical = index.lexical(query, candidates)
+        dense = self.vectordb.similarity_search_by_vector(embedding, k=HYBRID_CANDIDATES, filter=where)
+        if not len(index):
+            return dense[:k]
+        dense_ranking = [i for i in (index.position(doc.page_content) for doc in dense) if i is not None]
+        return [self._document(index, i) for i in reciprocal_rank_fusion([lexical, dense_ranking])[:k]]
+
+    async def aretrieve(self, query: str, k: int = DEFAULT_TOP_K):
+        """
+        Finds the chunks of a query in the shared vector store (see hybrid_search.py): from the chunk
+        metadata when the query names a known Kapitel/Thema, otherwise with BM25 and vector search fused.
+        Repeated (or, if enabled, near-duplicate) queries are answered from the query cache,
+        which is emptied when the store is updated (see invalidate_store).
+        The embedding and the search run in worker threads so they do not block the event loop serving
+        the other sessions, and the queries of concurrent sessions are embedded together (see embedding_batching.py).
+
+        Args:
+            query (str): the query, usually 'Kapitel: ... Thema: ...'
+            k (int): number of documents to return
+
+        Returns:
+            list: the retrieved langchain Documents
+        """
+        start = time.perf_counter()
+        found, index = await asyncio.to_thread(self._lookup, query, k)
+        if found is None:
+            embedding = await self._aembed_query(query)
+            found = await asyncio.to_thread(self._search, index, query, embedding, k)
+        docs, path = found
+        RETRIEVAL_SECONDS.observe(time.perf_counter() - start, path=path)
+        return docs
+
+    async def _aembed_query(self, query: str):
+        if self.query_batcher.max_batch_size <= 1:
+            return await asyncio.to_thread(self.embeddings.embed_query, query)
+        return await self.query_batcher.embed(query)
+
+    def _embed_queries(self, queries: list) -> list:
+        return embed_queries(self.embeddings, queries, self.model_name)
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_retrieval_service() -> RetrievalService:
+    """
+    Returns the process-wide RetrievalService, creating it on first use.
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RetrievalService()
+    return _service
@@ -1,32 +1,43 @@
 '''
 Routers used to decide what path to follow between agent and tool nodes
+The lesson flow is decided from the structured fields of AgentState (phase, current_tutor), written by the
+tool nodes (see routing_updates in agents.py), instead of searching the message contents.
 TODO: add more documentation to the routers, mostly rename variable for more clarity
 '''
 
+import os
 from typing import Literal
-from state import message_state
+from state import get_message_state
+from metrics import timed_wait
+from agents import PHASE_LESSON_PLANNED, PHASE_REPORTED, PHASE_FINISHED, closes_tutor_turn
+from tools import prepare_lesson
 from langchain_core.messages import (
     AIMessage,
+    ToolMessage,
 ) 
 
+# how many times the orchestrator is asked again when it answers in text instead of preparing the lesson
+# (e.g. after a failed getChunks), then the learner goes back to the communicator to choose another lesson
+ORCHESTRATOR_MAX_RETRIES = int(os.getenv("ORCHESTRATOR_MAX_RETRIES", "2"))
+
 # define the router function
 def router_tracker(state) -> Literal["call_tool", "kill_process"]:
     print('-- tracker router --')
-    messages = state["messages"]
-    last_message = messages[-1]
     # depends only on the start_signal output
-    if 'kill_process' in last_message.content:
+    if state.get('phase') == PHASE_FINISHED:
         return "kill_process"
     else:
         return "call_tool" #to force start_signal call
     
-def route_to_tutor(state) -> Literal["conversational", "reader", "listening", "questionAnswering", "grammarSummary", "no_more_lesson"]:
+def route_to_tutor(state) -> Literal["conversational", "reader", "listening", "questionAnswering", "grammarSummary", "no_more_lesson", "tracker"]:
     print('-- tracker_call_tool router --')
-    messages = state["messages"]
-    #print('testing start_signal output: ', messages[-1].content)
-    agent = messages[-1].content
-    state['messages'][-1].content += 'TUTOR AGENT PLEASE CALL YOUR TOOL'
-    return [agent]
+    if state.get('phase') == PHASE_FINISHED:
+        return "no_more_lesson"
+    # current_tutor is the agent picked by start_signal, it is missing when the tracker answered
+    # with text instead of calling start_signal: the tracker is asked again, the lesson is not over
+    if not state.get('current_tutor'):
+        return "tracker"
+    return state['current_tutor']
 
 async def router_tutor(state) -> Literal["call_tool", "continue", "FINAL REPORT"]:
     ''' BUG: sometimes the tutor starts the convo without calling its tool, fix asap @urgent'''
@@ -40,21 +51,23 @@ async def router_tutor(state) -> Literal["call_tool", "continue", "FINAL REPORT"
     if last_message.tool_calls:
         return "call_tool"
     
-    if "REPORT DONE" in last_message.content:
+    # the report was written by create_progress_report, "REPORT DONE" is kept for tutors that only say it
+    if closes_tutor_turn(state, last_message):
         return "FINAL REPORT"
 
     if isinstance(last_message, AIMessage) and last_message.content != '':
         print('succesful test')
+        message_state = get_message_state() # state of the session this graph run belongs to
         # THIS IS TO UPDATE THE LAST MESSAGE TO THEN SEND IT TO THE CLIENT
         message_state.update_content(last_message.content, last_message.name)
         # WAIT FOR ACK TO SEE IF CLIENT RECIEVED AIMESSAGE
-        await message_state.wait_for_acknowledgment()
+        await timed_wait("ack", message_state.wait_for_acknowledgment())
 
         print('AI ASSISTANT: ', last_message.content)
 
         print('You:')
         # WAIT FOR THE CLIENT TO SEND THE USER INPUT
-        user_input = await message_state.wait_for_input()
+        user_input = await timed_wait("input", message_state.wait_for_input())
         print(user_input)
       
         last_message.content += " user response: " + user_input
@@ -62,40 +75,46 @@ async def router_tutor(state) -> Literal["call_tool", "continue", "FINAL REPORT"
     
     return "call_tool" #forcing call tool (sometimes agent starts conversation anyways, need to fix that)
 
-def route_back_to_tutor(state) -> Literal['conversational', 'reader', 'listening', 'grammarSummary', 'questionAnswering']:
+def route_back_to_tutor(state) -> Literal['conversational', 'reader', 'listening', 'grammarSummary', 'questionAnswering', 'FINAL REPORT']:
     print('-- tutor call tool router --')
-    ''' There is 100% a better way to do this, should look into it'''
-    messages = state["messages"]
-    last_message = messages[-1]
-    if 'FINAL REPORT' and 'reader' in last_message.content:
-        return 'reader'
-    if 'FINAL REPORT' and 'conversational' in last_message.content:
-        return 'conversational'
-    if 'FINAL REPORT' and 'listening' in last_message.content:
-        return 'listening'
-    if 'FINAL REPORT' and 'questionAnswering' in last_message.content:
-        return 'questionAnswering'
-    if 'FINAL REPORT' and 'grammarSummary' in last_message.content:
-        return 'grammarSummary'
-    if 'conversational' in last_message.content: 
-        return 'conversational'
-    if 'reader' in last_message.content:
-        return 'reader'
-    if 'listening' in last_message.content:
-        return 'listening'
-    if 'questionAnswering' in last_message.content:
-        return 'questionAnswering'
-    if 'grammarSummary' in last_message.content:
-        return 'grammarSummary'
+    # once the progress report is written the tutor has nothing left to do, go straight to the tracker
+    if state.get('phase') == PHASE_REPORTED:
+        return 'FINAL REPORT'
+    # back to the tutor that called the tool (sender also covers conversations saved before current_tutor existed)
+    return state.get('current_tutor') or state['sender']
     
-def orchestrator_router(state) -> Literal['continue_to_tracker', 'call_tool']:
+def orchestrator_text_replies(messages) -> int:
+    ''' number of text replies of the orchestrator since the communicator handed over the lesson query '''
+    replies = 0
+    for message in reversed(messages):
+        if isinstance(message, ToolMessage):
+            continue
+        if not isinstance(message, AIMessage) or message.name != 'orchestrator':
+            break
+        replies += not message.tool_calls
+    return replies
+
+def orchestrator_router(state) -> Literal['continue_to_tracker', 'call_tool', 'orchestrator', 'communicator']:
     print('-- orchestrator router --')
     messages = state['messages']
     last_message = messages[-1]
     if last_message.tool_calls: 
         return 'call_tool'
-    if 'continue' in last_message.content: #if both tools have been called go to the tracker
+    if state.get('phase') == PHASE_LESSON_PLANNED: #if the lesson plan is ready go to the tracker
         return 'continue_to_tracker'
+    # no lesson plan (getChunks failed or was not called): ask again, then let the learner choose another lesson
+    if orchestrator_text_replies(messages) <= ORCHESTRATOR_MAX_RETRIES:
+        print(f'[WARNING] - the orchestrator answered without preparing a lesson plan, asking again: {last_message.content}')
+        return 'orchestrator'
+    print('[WARNING] - the orchestrator could not prepare the lesson plan, back to the communicator')
+    return 'communicator'
+
+def route_after_chunks(state) -> Literal['continue_to_tracker', 'orchestrator']:
+    print('-- orchestrator call tool router --')
+    # getChunks prepared the plan, the orchestrator would only answer continue_to_tracker
+    if state.get('phase') == PHASE_LESSON_PLANNED:
+        return 'continue_to_tracker'
+    return 'orchestrator'
     
 async def communicator_router(state) -> Literal['continue', 'go_orchestrator', 'call_tool']:
     print('-- communicator router --')
@@ -105,30 +124,36 @@ async def communicator_router(state) -> Literal['continue', 'go_orchestrator', '
     if last_message.tool_calls:
         return "call_tool"
     
+    message_state = get_message_state() # state of the session this graph run belongs to
+
     if 'go_orchestrator' in last_message.content:
         print('AI ASSISTANT: lecture content \n', last_message.content)
         msg = last_message.content.replace('go_orchestrator', '')
+        # the orchestrator will ask for this lesson, keep (or start) its preparation and drop the other candidates
+        message_state.prefetch.observe(msg, prepare_lesson)
         # THIS IS TO UPDATE THE LAST MESSAGE TO THEN SEND IT TO THE CLIENT
         message_state.update_content(msg, last_message.name)
         # WAIT FOR ACK TO SEE IF CLIENT RECIEVED AIMESSAGE
-        await message_state.wait_for_acknowledgment()
+        await timed_wait("ack", message_state.wait_for_acknowledgment())
         # ideally we save in a custom memory the communicator message
         # global custom_communicator_memory_save
         # custom_communicator_memory_save = messages #this saves just in case but not used anywhere atm (could be useful for later?)
         return 'go_orchestrator'
 
     if isinstance(last_message, AIMessage) and last_message.content != '':
+        # the lessons recommended here are prepared in the background while the learner answers
+        message_state.prefetch.observe(last_message.content, prepare_lesson)
         # THIS IS TO UPDATE THE LAST MESSAGE TO THEN SEND IT TO THE CLIENT
         message_state.update_content(last_message.content, last_message.name)
         # WAIT FOR ACK TO SEE IF CLIENT RECIEVED AIMESSAGE
-        await message_state.wait_for_acknowledgment()
+        await timed_wait("ack", message_state.wait_for_acknowledgment())
 
         #debugging
         print('AI ASSISTANT: ', last_message.content)
 
         print('You:')
         # WAIT FOR THE CLIENT TO SEND THE USER INPUT
-        user_input = await message_state.wait_for_input()
+        user_input = await timed_wait("input", message_state.wait_for_input())
         print(user_input)
         
         last_message.content += " user response: " + user_input
@@ -0,0 +1,135 @@
+'''
+Compares embedding configurations of the retrieval path (see embeddings.py).
+For each configuration, in its own process so the memory figures do not mix:
+- load time and resident memory added by the model
+- latency of one query embedding (p50/p95), the operation on the getChunks hot path
+- recall@3 on the Kapitel/Thema queries: overlap of the top 3 chunks with the ones of the reference
+  configuration (the first one, by default the current BAAI/bge-large-en-v1.5 on PyTorch),
+  and lesson@3: share of the top 3 chunks belonging to the lesson named by the query
+The chunks are the blocks of data/relevant_content.txt, as ingest.py stores them, searched exhaustively.
+
+usage: python scripts/bench_embeddings.py [--configs hf:BAAI/bge-large-en-v1.5,onnx:BAAI/bge-small-en-v1.5:int8] [--repeat 20]
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+DEFAULT_CONFIGS = ",".join([
+    "hf:BAAI/bge-large-en-v1.5",
+    "hf:BAAI/bge-small-en-v1.5",
+    "onnx:BAAI/bge-large-en-v1.5:int8",
+    "onnx:BAAI/bge-small-en-v1.5:int8",
+    "onnx:BAAI/bge-small-en-v1.5",
+])
+TOP_K = 3
+
+
+def parse_config(config: str) -> tuple:
+    ''' "backend:model[:quantize]" -> (backend, model, quantize) '''
+    backend, rest = config.split(":", 1)
+    model, _, quantize = rest.partition(":") if backend == "onnx" else (rest, "", "")
+    return backend, model, quantize
+
+
+def corpus():
+    ''' (chunk texts, chunk lessons, [(query, lesson)]) '''
+    from ingest import build_chunks
+    from lesson_plan import parse_content_blocks
+
+    chunks = list(build_chunks(parse_content_blocks(), "relevant_content.txt").values())
+    queries = {}
+    for chunk in chunks:
+        metadata = chunk["metadata"]
+        kapitel, thema, lesson = metadata["kapitel"], metadata["thema"], metadata["lesson"]
+        queries.setdefault(f"Kapitel: {kapitel} Thema: {thema}", lesson)
+        if thema:  # shortened thema, as the communicator often writes it
+            queries.setdefault(f"Kapitel: {kapitel} Thema: {thema.split()[0]}", lesson)
+        if metadata["kategorie"]:
+            queries.setdefault(f"Kapitel: {kapitel} Thema: {thema} {metadata['kategorie']}", lesson)
+    return [c["text"] for c in chunks], [c["metadata"]["lesson"] for c in chunks], list(queries.items())
+
+
+def run_one(config: str, repeat: int) -> dict:
+    ''' measures one configuration in this process '''
+    import numpy as np
+    from embeddings import create_embeddings
+    from retrieval import _current_rss_mb
+
+    texts, _, queries = corpus()
+    backend, model, quantize = parse_config(config)
+    rss_before = _current_rss_mb()
+    start = time.perf_counter()
+    embeddings = create_embeddings(backend, model, quantize)
+    embeddings.embed_query("warmup")
+    load_s = time.perf_counter() - start
+    rss_loaded = _current_rss_mb()
+
+    start = time.perf_counter()
+    documents = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    documents_s = time.perf_counter() - start
+
+    latencies, top = [], []
+    for query, _ in queries:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            vector = embeddings.embed_query(query)
+            latencies.append(time.perf_counter() - start)
+        scores = documents @ np.asarray(vector, dtype=np.float32)
+        top.append([int(i) for i in np.argsort(-scores)[:TOP_K]])
+    latencies.sort()
+    return {
+        "config": config,
+        "load_s": round(load_s, 2),
+        "rss_mb": None if rss_loaded is None else round(rss_loaded, 1),
+        "model_rss_mb": None if rss_before is None else round(rss_loaded - rss_before, 1),
+        "documents_per_s": round(len(texts) / documents_s, 1),
+        "query_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "query_p95_ms": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000, 2),
+        "top": top,
+    }
+
+
+def main(configs: list, repeat: int) -> int:
+    _, lessons, queries = corpus()
+    results = []
+    for config in configs:
+        process = subprocess.run([sys.executable, __file__, "--run-one", config, "--repeat", str(repeat)],
+                                 cwd=ROOT, capture_output=True, text=True)
+        if process.returncode != 0:
+            error = (process.stderr.strip().splitlines() or ["failed"])[-1]
+            print(f"{config:<40} skipped: {error}")
+            continue
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    if not results:
+        return 1
+
+    reference = results[0]
+    print(f"\n{len(lessons)} chunks, {len(queries)} queries, reference: {reference['config']}\n")
+    print(f"{'config':<40} {'load s':>7} {'model MB':>9} {'q p50 ms':>9} {'q p95 ms':>9} {'docs/s':>8} {'recall@3':>9} {'lesson@3':>9}")
+    for result in results:
+        recall = sum(len(set(top) & set(ref)) / TOP_K for top, ref in zip(result["top"], reference["top"])) / len(queries)
+        lesson = sum(sum(lessons[i] == wanted for i in top) / TOP_K
+                     for top, (_, wanted) in zip(result["top"], queries)) / len(queries)
+        print(f"{result['config']:<40} {result['load_s']:>7} {str(result['model_rss_mb']):>9} {result['query_p50_ms']:>9} "
+              f"{result['query_p95_ms']:>9} {result['documents_per_s']:>8} {recall:>9.2f} {lesson:>9.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", default=DEFAULT_CONFIGS, help="comma separated backend:model[:quantize], the first is the reference")
+    parser.add_argument("--repeat", type=int, default=20, help="embeddings of each query for the latency")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.repeat)))
+        sys.exit(0)
+    sys.exit(main(args.configs.split(","), args.repeat))
@@ -0,0 +1,287 @@
+'''
+Offline end-to-end benchmark of the tutoring graph.
+The OpenAI models are replaced by a local fake chat model with a configurable latency that scripts the
+tool calls of every agent (getFiles, getChunks, start_signal, getLearningContent, create_progress_report),
+and the graph of graph_creation.build_graph is served by the real FastAPI app. N simulated learners then
+go through /startConversation, /getAIMessage, /acknowledgeMessage and /userInput over an in-process
+ASGI transport, from the recommendation to the end of the lesson.
+Reports sessions per second, the latency of each response and the memory of the process.
+The lesson asked for must be in data/lesson_plan_index.json, getChunks never calls OpenAI during the benchmark.
+
+usage: python scripts/bench_graph.py [--learners 20] [--llm-latency-ms 50] [--turns 2]
+'''
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# the caches, checkpoints and user store of the benchmark are written to a temporary directory
+WORKDIR = tempfile.mkdtemp(prefix="ell_bench_")
+os.environ.setdefault("OPENAI_API_KEY", "bench-no-key")
+os.environ.setdefault("METRICS_JSON_LOGS", "0")
+os.environ["LLM_CACHE_PATH"] = os.path.join(WORKDIR, "llm_cache.sqlite")
+os.environ["CHECKPOINT_DB_PATH"] = os.path.join(WORKDIR, "checkpoints.sqlite")
+os.environ["USER_STORE_PATH"] = os.path.join(WORKDIR, "users.sqlite")
+
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+DEFAULT_QUERY = "Kapitel: 1\nThema: Moien!... an Addi!"
+RECOMMENDATION = "Moien! Ech proposéieren dir Kapitel 1, Thema Moien!... an Addi!. Si mir d'accord?"
+LEARNER_REPLY = "Jo, dat ass gutt."
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering like the agents of the graph, recognized from their system prompt.
+    Every call waits latency_s, streamed replies are sent word by word.
+    """
+    model_name: str = "bench-fake"
+    temperature: float = 0.7
+    latency_s: float = 0.05
+    token_delay_s: float = 0.0
+    lesson_query: str = DEFAULT_QUERY
+    turns_per_lesson: int = 2
+
+    @property
+    def _llm_type(self) -> str:
+        return "bench-fake-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency_s)
+        return ChatResult(generations=[ChatGeneration(message=self.reply(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency_s)
+        return ChatResult(generations=[ChatGeneration(message=self.reply(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency_s)
+        message = self.reply(messages)
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)]))
+            return
+        for word in message.content.split(" "):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if self.token_delay_s:
+                await asyncio.sleep(self.token_delay_s)
+
+    def reply(self, messages) -> AIMessage:
+        system = messages[0].content if messages else ""
+        if system.startswith("You keep the memory"):  # the conversation summary of context.py
+            return AIMessage(content="The learner is following the lesson.")
+        if "You are the tracker" in system:
+            return _tool_call("start_signal", {})
+        if "your are the orchestrator" in system:
+            return self._orchestrator(messages)
+        if "you are the communicator" in system:
+            return self._communicator(messages)
+        tutor = re.search(r"you are the (\w+) agent", system)
+        if tutor:
+            return self._tutor(messages, tutor.group(1))
+        raise ValueError(f"unknown agent prompt: {system[:80]}")
+
+    def _communicator(self, messages) -> AIMessage:
+        if not any(isinstance(m, ToolMessage) and m.name == "getFiles" for m in messages):
+            user_id = re.search(r"user ID is (\S+?)\.", messages[1].content)
+            return _tool_call("getFiles", {"userID": user_id.group(1) if user_id else "001"})
+        if isinstance(messages[-1], AIMessage) and "user response:" in messages[-1].content:
+            return AIMessage(content=f"{self.lesson_query} go_orchestrator")
+        return AIMessage(content=RECOMMENDATION)
+
+    def _orchestrator(self, messages) -> AIMessage:
+        if isinstance(messages[-1], ToolMessage) and messages[-1].name == "getChunks":
+            return AIMessage(content="continue_to_tracker")
+        return _tool_call("getChunks", {"query": self.lesson_query})
+
+    def _tutor(self, messages, name: str) -> AIMessage:
+        last = messages[-1]
+        if isinstance(last, ToolMessage) and last.name == "start_signal":
+            return _tool_call("getLearningContent", {})
+        if isinstance(last, ToolMessage) and last.name == "create_progress_report":
+            return AIMessage(content="REPORT DONE")
+        start = max((i for i, m in enumerate(messages) if isinstance(m, ToolMessage) and m.name == "getLearningContent"), default=0)
+        turns = sum(1 for m in messages[start:] if isinstance(m, AIMessage) and m.content and m.name == name)
+        if turns >= self.turns_per_lesson:
+            return _tool_call("create_progress_report", {"agentName": name})
+        return AIMessage(content=f"Lektioun {turns + 1}: Moien heescht Bonjour. Wéi seet een Äddi?")
+
+
+def _tool_call(name: str, args: dict) -> AIMessage:
+    return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{uuid.uuid4().hex[:16]}"}])
+
+
+class NoOpenAIClient:
+    ''' stands for the AsyncOpenAI client of tools.py, getChunks must be answered from the lesson plan index '''
+
+    def __getattr__(self, name):
+        raise RuntimeError("getChunks fell back to the OpenAI client, use a --query that is in the lesson plan index")
+
+
+class MemorySampler:
+    ''' peak resident memory of the process, sampled in a thread '''
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_mb = self.start_mb = self._rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _rss():
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, self._rss())
+
+    def __enter__(self):
+        if self.start_mb is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else None
+
+
+async def learner(client, sessions, user_id: str, query: str, latencies: list) -> int:
+    ''' one learner from the start of the conversation to the end of the lesson, returns the number of messages '''
+    last_request = time.perf_counter()
+    response = await client.post("/startConversation", json={"startBool": True, "userID": user_id})
+    response.raise_for_status()
+    session_id = response.json()["sessionID"]
+    session = sessions.get(session_id)
+    received = 0
+    while True:
+        get = asyncio.ensure_future(client.get("/getAIMessage", params={"sessionID": session_id}))
+        await asyncio.wait({get, session.task}, return_when=asyncio.FIRST_COMPLETED)
+        if not get.done():  # the graph reached END, no more messages
+            get.cancel()
+            break
+        message = get.result().json()
+        latencies.append(time.perf_counter() - last_request)
+        received += 1
+        await client.post("/acknowledgeMessage", json={"ack": True, "sessionID": session_id})
+        last_request = time.perf_counter()
+        # the system notices and the chosen lesson do not wait for an answer
+        if message["agent_name"] != "system" and message["content"].strip() != query.strip():
+            await client.post("/userInput", json={"content": LEARNER_REPLY, "sessionID": session_id})
+            last_request = time.perf_counter()
+    session.task.result()  # raises if the graph failed
+    return received
+
+
+async def run(args):
+    import mainapp
+    import tools
+    from checkpointing import configure_checkpointer, create_checkpointer
+    from graph_creation import build_graph
+    from lesson_plan import lookup_lesson_plan
+
+    if lookup_lesson_plan(args.query) is None:
+        raise SystemExit(f"{args.query!r} is not in the lesson plan index, run python lesson_plan.py first")
+    os.environ["LANGCHAIN_TRACING_V2"] = "false"  # the fake calls must not be traced, even with tracing in .env
+    tools._openai_client = NoOpenAIClient()
+    import context
+    fake = dict(latency_s=args.llm_latency_ms / 1000, token_delay_s=args.token_delay_ms / 1000,
+                lesson_query=args.query, turns_per_lesson=args.turns)
+    context._summarizer = FakeChatModel(temperature=0, **fake)
+
+    async def load_bench_graph():
+        memory = create_checkpointer(os.environ["CHECKPOINT_DB_PATH"])
+        await configure_checkpointer(memory)
+        await asyncio.to_thread(context.load_encoder)
+        graph = build_graph(FakeChatModel(**fake), memory)
+        return SimpleNamespace(graph=graph, memory=memory)
+
+    # only the graph is served, the retrieval and TTS models are not needed for the text chat
+    mainapp.startup_manager.register("graph", load_bench_graph)
+    mainapp.startup_manager.register("retrieval", lambda: None, required=False)
+    mainapp.startup_manager.register("tts", lambda: None, required=False)
+
+    user_ids = args.user_ids.split(",")
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency or args.learners)
+
+    async def one(i):
+        async with semaphore:
+            return await learner(client, mainapp.sessions, user_ids[i % len(user_ids)], args.query, latencies)
+
+    transport = httpx.ASGITransport(app=mainapp.app)
+    async with mainapp.lifespan(mainapp.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            await mainapp.startup_manager.wait("graph")
+            with MemorySampler() as memory:
+                start = time.perf_counter()
+                results = await asyncio.gather(*[one(i) for i in range(args.learners)], return_exceptions=True)
+                elapsed = time.perf_counter() - start
+            metrics = (await client.get("/metrics")).text
+
+    failures = [r for r in results if isinstance(r, BaseException)]
+    messages = sum(r for r in results if not isinstance(r, BaseException))
+    return {
+        "learners": args.learners,
+        "concurrency": args.concurrency or args.learners,
+        "llm_latency_ms": args.llm_latency_ms,
+        "failed_sessions": len(failures),
+        "first_error": repr(failures[0]) if failures else None,
+        "elapsed_s": round(elapsed, 3),
+        "sessions_per_s": round((args.learners - len(failures)) / elapsed, 3),
+        "messages": messages,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "rss_start_mb": None if memory.start_mb is None else round(memory.start_mb, 1),
+        "rss_peak_mb": None if memory.peak_mb is None else round(memory.peak_mb, 1),
+        "llm_cache_hits": next((float(l.split()[-1]) for l in metrics.splitlines()
+                                if l.startswith('ell_cache_lookups{cache="llm",result="hit"}')), None),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--learners", type=int, default=20, help="number of simulated learners")
+    parser.add_argument("--concurrency", type=int, default=0, help="learners running at the same time (default: all)")
+    parser.add_argument("--llm-latency-ms", type=float, default=50, help="latency of every fake LLM call")
+    parser.add_argument("--token-delay-ms", type=float, default=0, help="delay between two streamed words")
+    parser.add_argument("--turns", type=int, default=2, help="answers of the learner per lesson step")
+    parser.add_argument("--query", default=DEFAULT_QUERY, help="lesson chosen by the communicator")
+    parser.add_argument("--user-ids", default="001,002", help="comma separated learners of data/user_profile_file.json")
+    parser.add_argument("--verbose", action="store_true", help="keep the prints of the graph")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per request otherwise
+
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+        report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,99 @@
+'''
+Startup time of the server.
+1. import time of mainapp, measured with python -X importtime (total and the slowest top level imports)
+2. a real uvicorn worker: time until /health answers, and until each component of /ready is loaded
+
+usage: python scripts/bench_startup.py [--top 10] [--timeout 120]
+'''
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module: str):
+    ''' (total_us, [(cumulative_us, name)]) of the imports done by "import module" '''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2  # nested imports are indented by 2 spaces
+        rows.append((int(cumulative_us), depth, name.strip()))
+    total = next(cumulative for cumulative, depth, name in rows if depth == 0 and name == module)
+    top_level = sorted(((cumulative, name) for cumulative, depth, name in rows if depth == 1), reverse=True)
+    return total, top_level
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_json(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def server_startup(timeout: float):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "mainapp:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    health_s, components = None, {}
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if health_s is None:
+                    get_json(base + "/health")
+                    health_s = time.perf_counter() - start
+                _, status = get_json(base + "/ready")
+                for name, info in status["components"].items():
+                    if info["status"] in ("ready", "failed") and name not in components:
+                        components[name] = (time.perf_counter() - start, info["status"])
+                if len(components) == len(status["components"]):
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+    return health_s, components
+
+
+def main(top: int, timeout: float):
+    total, top_level = import_times("mainapp")
+    print(f"import mainapp: {total / 1e6:.2f}s")
+    for cumulative, name in top_level[:top]:
+        print(f"  {cumulative / 1e3:>8.0f} ms  {name}")
+
+    health_s, components = server_startup(timeout)
+    print(f"\n/health answered after {health_s:.2f}s" if health_s is not None else "\n/health never answered")
+    for name, (seconds, status) in sorted(components.items(), key=lambda item: item[1][0]):
+        print(f"  {name:<10} {status:<7} after {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=10, help="number of slow imports shown")
+    parser.add_argument("--timeout", type=float, default=120, help="how long to wait for the components (in seconds)")
+    args = parser.parse_args()
+    main(args.top, args.timeout)
@@ -0,0 +1,70 @@
+'''
+Batched vs sequential TTS synthesis.
+Sends bursts of concurrent sentences to a TTSWorkerPool without batching (batch size 1) and with
+micro-batching for each batch size, and reports requests per second and p50/p95 latency.
+The audio cache is disabled so every request is synthesized. Needs the TTS model (tts/best_model.pth).
+
+usage: python scripts/bench_tts_batching.py --batch-sizes 1 4 8 --requests 32 --workers 1
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # setupTTS uses paths relative to the repository
+
+from tts.pool import TTSWorkerPool
+
+SENTENCES = [
+    "Moien!",
+    "Wéi geet et?",
+    "Gudde Mëtteg, Madame!",
+    "Ech heesche Luc, an du?",
+    "Ech kommen aus Lëtzebuerg.",
+    "Äddi a Merci fir d'Invitatioun!",
+]
+
+
+async def measure(pool: TTSWorkerPool, n_requests: int):
+    latencies = []
+
+    async def one(i):
+        start = time.perf_counter()
+        await pool.synthesize_pcm(SENTENCES[i % len(SENTENCES)])
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(n_requests)])
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return wall, latencies[len(latencies) // 2] * 1000, latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000
+
+
+async def main(batch_sizes, n_requests: int, workers: int, wait_ms: float):
+    print(f"{'batch':>6} {'requests':>9} {'wall (s)':>9} {'req/s':>7} {'p50 (ms)':>9} {'p95 (ms)':>9} {'mean batch':>11}")
+    for batch_size in batch_sizes:
+        pool = TTSWorkerPool(workers=workers, max_pending=n_requests, cache=None,
+                             batch_size=batch_size, batch_wait_ms=wait_ms)
+        await asyncio.to_thread(pool.start)
+        await pool.synthesize_pcm(SENTENCES[0])  # first call is slower, keep it out of the numbers
+        if pool.batcher is not None:
+            pool.batcher.batches = pool.batcher.batched_requests = 0
+        wall, p50, p95 = await measure(pool, n_requests)
+        mean_batch = pool.batcher.stats()['mean_batch_size'] if pool.batcher is not None else 1
+        label = batch_size if batch_size > 1 else "seq"
+        print(f"{label:>6} {n_requests:>9} {wall:>9.2f} {n_requests / wall:>7.2f} {p50:>9.0f} {p95:>9.0f} {mean_batch:>11.1f}")
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--wait-ms", type=float, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_sizes, args.requests, args.workers, args.wait_ms))
@@ -0,0 +1,54 @@
+'''
+Throughput and latency of the TTS worker pool for several worker counts.
+Sends the same burst of concurrent requests to a TTSWorkerPool with 1, 2, 4... workers and
+reports requests per second and p50/p95 latency for each. Needs the TTS model (tts/best_model.pth).
+
+usage: python scripts/bench_tts_pool.py --workers 1 2 4 --requests 16
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # setupTTS uses paths relative to the repository
+
+from tts.pool import TTSWorkerPool
+
+SENTENCES = [
+    "Moien! Wéi geet et?",
+    "Gudde Mëtteg, Madame!",
+    "An der Zäit hunn sech den Nordwand an d'Sonn gestridden, wie vun hinnen zwee wuel méi staark wier.",
+    "Äddi a Merci fir d'Invitatioun!",
+]
+
+
+async def run_burst(pool: TTSWorkerPool, n_requests: int):
+    start = time.perf_counter()
+    await asyncio.gather(*[pool.synthesize(SENTENCES[i % len(SENTENCES)]) for i in range(n_requests)])
+    return time.perf_counter() - start
+
+
+async def main(worker_counts, n_requests: int):
+    print(f"{'workers':>8} {'requests':>9} {'wall (s)':>9} {'req/s':>7} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for workers in worker_counts:
+        pool = TTSWorkerPool(workers=workers, max_pending=n_requests)
+        await asyncio.to_thread(pool.start)
+        await pool.synthesize(SENTENCES[0])  # first call is slower, keep it out of the numbers
+        pool._timings.clear()
+        wall = await run_burst(pool, n_requests)
+        stats = pool.stats()
+        print(f"{workers:>8} {n_requests:>9} {wall:>9.2f} {n_requests / wall:>7.2f} "
+              f"{stats['p50_ms']:>9.0f} {stats['p95_ms']:>9.0f}")
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.requests))
@@ -0,0 +1,157 @@
+'''
+Checks that parallel tutoring sessions progress without head-of-line blocking.
+N sessions run turns through agent_node and streaming_agent_node concurrently, with an
+agent that simulates the latency of an LLM call. If the nodes block the event loop the
+total time grows with N, otherwise it stays close to the time of a single session.
+A probe task also measures how late the event loop wakes up while the sessions run.
+It first checks the previews streamed by streaming_agent_node: the routing markers never reach
+the client, and a reply no router sends (tool call, closing reply of a tutor) is discarded.
+
+usage: python scripts/check_concurrency.py --sessions 50 --turns 3 --latency 0.5
+'''
+
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.runnables import RunnableGenerator, RunnableLambda
+
+from agents import PHASE_REPORTED, STREAM_HIDDEN_MARKERS, agent_node, streaming_agent_node
+from state import current_session_id, sessions
+
+
+def make_fake_agent(latency: float):
+    ''' an agent answering after `latency` seconds without blocking, like ainvoke/astream on ChatOpenAI '''
+    async def answer(state):
+        await asyncio.sleep(latency)
+        return AIMessage(content="Moien! Wéi geet et?")
+
+    async def stream_answer(states):
+        async for _ in states:
+            for token in ["Moien!", " Wéi", " geet", " et?"]:
+                await asyncio.sleep(latency / 4)
+                yield AIMessageChunk(content=token)
+
+    return RunnableLambda(answer), RunnableGenerator(stream_answer)
+
+
+async def run_session(index: int, turns: int, invoke_agent, stream_agent):
+    session = sessions.create(user_id=f"{index:03d}")
+    current_session_id.set(session.session_id)
+    state = {"messages": [HumanMessage(content="hi")], "sender": "user"}
+    nodes = [
+        functools.partial(agent_node, agent=invoke_agent, name="tracker"),
+        functools.partial(streaming_agent_node, agent=stream_agent, name="conversational"),
+    ]
+    start = time.perf_counter()
+    for turn in range(turns):
+        for node in nodes:
+            await node(state)
+    sessions.remove(session.session_id)
+    return time.perf_counter() - start
+
+
+class ScriptedStreamAgent:
+    ''' streams the given chunks, like astream on ChatOpenAI '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def astream(self, state):
+        for chunk in self.chunks:
+            yield chunk
+
+
+_TOOL_CALL = AIMessageChunk(content="", tool_call_chunks=[{"name": "getLearningContent", "args": "{}", "id": "call_1", "index": 0}])
+
+# (description, agent name, phase, streamed chunks, whether the preview must be discarded)
+PREVIEW_CASES = [
+    ("plain tutor reply", "conversational", None,
+     [AIMessageChunk(content="Moien!"), AIMessageChunk(content=" Wéi geet et?")], False),
+    ("text followed by a tool call", "conversational", None,
+     [AIMessageChunk(content="Ech sichen den Inhalt."), _TOOL_CALL], True),
+    ("tutor reply ending with REPORT DONE", "reader", None,
+     [AIMessageChunk(content="Gutt gemaach! REP"), AIMessageChunk(content="ORT DONE")], True),
+    ("tutor reply after its progress report", "reader", PHASE_REPORTED,
+     [AIMessageChunk(content="Äddi!")], True),
+    ("communicator query split over chunks", "communicator", None,
+     [AIMessageChunk(content="Kapitel: 2 \nThema: Wéi geet et? go_orch"), AIMessageChunk(content="estrator")], False),
+]
+
+
+async def check_stream_previews() -> int:
+    ''' returns the number of PREVIEW_CASES whose streamed events are wrong '''
+    failures = 0
+    for description, name, phase, chunks, discarded in PREVIEW_CASES:
+        session = sessions.create(user_id="preview")
+        current_session_id.set(session.session_id)
+        state = {"messages": [HumanMessage(content="hi")], "sender": "user", "phase": phase}
+        await streaming_agent_node(state, ScriptedStreamAgent(chunks), name, cacheable=False)
+        events = []
+        while not session.ai_messages.empty():
+            events.append(session.ai_messages.get_nowait())
+        sessions.remove(session.session_id)
+        shown = "".join(event["content"] for event in events if event["type"] == "delta")
+        ok = (not any(marker in shown for marker in STREAM_HIDDEN_MARKERS)
+              and (bool(events) and events[-1]["type"] == "discard") == discarded)
+        failures += not ok
+        print(f"[{' OK ' if ok else 'FAIL'}] preview of {description}")
+        if not ok:
+            print(f"         events {events}")
+    return failures
+
+
+async def probe_loop_lag(stop: asyncio.Event, interval: float = 0.01):
+    ''' returns the worst delay between the expected and actual wake up of the event loop '''
+    worst = 0.0
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - expected)
+    return worst
+
+
+async def main(n_sessions: int, turns: int, latency: float):
+    if await check_stream_previews():
+        print("FAILED: streamed previews")
+        return 1
+
+    invoke_agent, stream_agent = make_fake_agent(latency)
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_loop_lag(stop))
+
+    start = time.perf_counter()
+    durations = await asyncio.gather(*[
+        asyncio.create_task(run_session(i, turns, invoke_agent, stream_agent)) for i in range(n_sessions)
+    ])
+    total = time.perf_counter() - start
+    stop.set()
+    worst_lag = await probe
+
+    single_session = turns * 2 * latency  # two LLM calls per turn
+    print(f"sessions: {n_sessions}, turns per session: {turns}, simulated LLM latency: {latency}s")
+    print(f"expected time of one session: {single_session:.2f}s")
+    print(f"total time for all sessions:  {total:.2f}s (slowest session {max(durations):.2f}s)")
+    print(f"worst event loop lag:         {worst_lag * 1000:.1f}ms")
+
+    # with head-of-line blocking the total would be close to n_sessions * single_session
+    if total > single_session * 1.5:
+        print("FAILED: sessions are blocking each other")
+        return 1
+    print("OK: sessions progress concurrently")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.sessions, args.turns, args.latency)))
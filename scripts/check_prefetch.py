@@ -0,0 +1,55 @@
+'''
+Checks the Kapitel/Thema candidates the prefetcher (see prefetch.py) finds in communicator messages.
+Each case is a phrasing of the communicator and the queries that must be prepared for it, the lessons of
+data/lesson_plan_index.json being recognized by name. The lessons are compared exactly: a thema captured
+past its end (e.g. with the "oder" of "A oder B") fails. No LLM needed. Exits with 1 if a case fails.
+
+usage: python scripts/check_prefetch.py
+'''
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from prefetch import candidate_queries, lesson_id
+
+CASES = [
+    ("the go_orchestrator query",
+     "Kapitel: 2 \nThema: Wéi geet et? ",
+     ["Kapitel: 2 Thema: Wéi geet et?"]),
+    ("two lessons offered as A oder B",
+     "Mir kënnen Kapitel: 2 Thema: Wéi geet et? oder Kapitel: 3 Thema: Iessen an Drénken? Wat mengs du?",
+     ["Kapitel: 2 Thema: Wéi geet et?", "Kapitel: 3 Thema: Iessen an Drénken?"]),
+    ("A oder B without punctuation",
+     "Kapitel 2, Thema Wéi geet et oder Kapitel 3, Thema Iessen",
+     ["Kapitel: 2 Thema: Wéi geet et", "Kapitel: 3 Thema: Iessen"]),
+    ("quoted thema followed by a question",
+     'I recommend Kapitel 4, Thema "Meng Famill" oder eppes anescht?',
+     ["Kapitel: 4 Thema: Meng Famill"]),
+    ("lesson of the index named by its first word",
+     "Wéi wier et mat Kapitel 1, Moien? Oder léiwer eppes anescht?",
+     ["Kapitel: 1 Thema: Moien!... an Addi!"]),
+    ("a message without any lesson",
+     "Moien! Wéi heescht du?",
+     []),
+]
+
+
+def main() -> int:
+    failures = 0
+    for description, text, expected in CASES:
+        found = candidate_queries(text, max_candidates=len(expected) or 1)
+        ok = [lesson_id(query) for query in found] == [lesson_id(query) for query in expected]
+        failures += not ok
+        print(f"[{' OK ' if ok else 'FAIL'}] {description}")
+        if not ok:
+            print(f"         found {found}, expected {expected}")
+    print(f"\n{len(CASES) - failures}/{len(CASES)} phrasings resolved as expected")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+'''
+Replays recorded graph transitions against the routers.
+Each transition of scripts/routing_transitions.json gives the state before a router, the tool outputs of
+the tool node that ran just before it (if any), and the edge the router must choose. The tool outputs go
+through routing_updates exactly like in the graph, so the structured routing fields are checked too.
+No LLM call or client session is made, but agents.py builds its ChatOpenAI models on import: a placeholder
+OPENAI_API_KEY is set when none is configured, it is never sent anywhere. Exits with 1 if a transition is misrouted.
+
+usage: python scripts/replay_routing.py [--transitions scripts/routing_transitions.json]
+'''
+
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# importing agents.py creates the ChatOpenAI clients, which refuse to be built without a key (no request is made)
+os.environ.setdefault("OPENAI_API_KEY", "replay-routing-no-llm")
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import routers
+from agents import routing_updates
+
+_MESSAGE_TYPES = {"ai": AIMessage, "human": HumanMessage, "tool": ToolMessage}
+
+
+def load_state(recorded: dict) -> dict:
+    state = {key: value for key, value in recorded.items() if key != "messages"}
+    state["messages"] = [_MESSAGE_TYPES[m["type"]](**{k: v for k, v in m.items() if k != "type"})
+                         for m in recorded["messages"]]
+    return state
+
+
+def replay(transition: dict):
+    ''' returns (edge chosen by the router, state after the tool node) '''
+    state = load_state(transition["state"])
+    if "tool_results" in transition:
+        update = routing_updates(state, [ToolMessage(**result) for result in transition["tool_results"]])
+        state = {**state, **update, "messages": state["messages"] + update["messages"]}
+    edge = getattr(routers, transition["router"])(state)
+    if inspect.isawaitable(edge):
+        edge = asyncio.run(edge)
+    return edge, state
+
+
+def main(path: str) -> int:
+    with open(path, 'r', encoding='utf-8') as file:
+        transitions = json.load(file)
+    failures = 0
+    for transition in transitions:
+        try:
+            edge, state = replay(transition)
+            problems = [] if edge == transition["expected"] else [f"edge {edge!r}, expected {transition['expected']!r}"]
+            for key, expected in transition.get("expected_state", {}).items():
+                if state.get(key) != expected:
+                    problems.append(f"{key} = {state.get(key)!r}, expected {expected!r}")
+        except Exception as e:
+            problems = [f"{type(e).__name__}: {e}"]
+        failures += bool(problems)
+        print(f"[{'FAIL' if problems else ' OK '}] {transition['router']:<20} {transition['description']}")
+        for problem in problems:
+            print(f"         {problem}")
+    print(f"\n{len(transitions) - failures}/{len(transitions)} transitions routed as recorded")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transitions", default=os.path.join(ROOT, "scripts", "routing_transitions.json"))
+    args = parser.parse_args()
+    sys.exit(main(args.transitions))
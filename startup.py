@@ -0,0 +1,127 @@
+'''
+Startup manager of the server.
+Importing the graph (langchain, langgraph, nine agents), the embedder and the TTS models takes seconds,
+so mainapp only registers them here. They are loaded in background tasks when the app starts and each
+component reports its own readiness: the health check answers immediately, text chat is available as
+soon as the graph is loaded, and retrieval/TTS keep warming up behind it.
+'''
+
+import asyncio
+import inspect
+import time
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class ComponentUnavailable(Exception):
+    """
+    Raised when a component failed to load or is not loaded in time.
+    """
+
+
+class Component:
+    """
+    One lazily loaded part of the app.
+    """
+
+    def __init__(self, name: str, loader, required: bool):
+        self.name = name
+        self.loader = loader
+        self.required = required
+        self.status = PENDING
+        self.value = None
+        self.error = None
+        self.load_time_s = None
+        self.loaded = asyncio.Event()
+
+    def info(self) -> dict:
+        return {
+            "status": self.status,
+            "required": self.required,
+            "load_time_s": self.load_time_s,
+            "error": None if self.error is None else str(self.error),
+        }
+
+
+class StartupManager:
+    """
+    Loads the registered components in the background and tracks their readiness.
+    """
+
+    def __init__(self):
+        self.components = {}
+        self.started_at = None
+        self._tasks = []
+
+    def register(self, name: str, loader, required: bool = True):
+        """
+        Args:
+            name (str): the component name, as shown by /ready.
+            loader (callable): returns the loaded component. A plain function runs in a thread,
+                a coroutine function runs on the event loop.
+            required (bool): whether the app is ready without this component.
+        """
+        self.components[name] = Component(name, loader, required)
+
+    async def _load(self, component: Component):
+        component.status = LOADING
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(component.loader):
+                component.value = await component.loader()
+            else:
+                component.value = await asyncio.to_thread(component.loader)
+            component.status = READY
+            print(f"[INFO] - {component.name} ready in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            component.status = FAILED
+            component.error = e
+            print(f"[ERROR] - {component.name} could not be loaded: {e}")
+        finally:
+            component.load_time_s = round(time.perf_counter() - start, 3)
+            component.loaded.set()
+
+    def start(self):
+        ''' starts loading every component, call it from the app lifespan '''
+        self.started_at = time.perf_counter()
+        self._tasks = [asyncio.create_task(self._load(component)) for component in self.components.values()]
+
+    async def wait(self, name: str, timeout: float = None):
+        """
+        Waits for a component to be loaded and returns it.
+
+        Raises:
+            ComponentUnavailable: if the component failed to load or the timeout expired.
+        """
+        component = self.components[name]
+        try:
+            await asyncio.wait_for(component.loaded.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise ComponentUnavailable(f"{name} is still loading")
+        if component.status != READY:
+            raise ComponentUnavailable(f"{name} could not be loaded: {component.error}")
+        return component.value
+
+    def get(self, name: str):
+        ''' the component if it is loaded, None otherwise '''
+        component = self.components[name]
+        return component.value if component.status == READY else None
+
+    def is_ready(self) -> bool:
+        ''' True when every required component is loaded '''
+        return all(c.status == READY for c in self.components.values() if c.required)
+
+    def status(self) -> dict:
+        return {
+            "ready": self.is_ready(),
+            "uptime_s": None if self.started_at is None else round(time.perf_counter() - self.started_at, 3),
+            "components": {name: component.info() for name, component in self.components.items()},
+        }
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
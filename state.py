@@ -1,35 +1,149 @@
 import asyncio
+import contextvars
+import time
+import uuid
+from collections import deque
+
+# bound on every per-session queue, a slow or absent client cannot make a session grow without limit
+MAX_QUEUE_SIZE = 32
+# sessions without any activity for this long are evicted (in seconds)
+SESSION_IDLE_TIMEOUT = 30 * 60
+
+# id of the session the current graph run belongs to.
+# It is set by mainapp before running the graph and is inherited by the nodes, routers and tools
+current_session_id = contextvars.ContextVar("current_session_id", default=None)
+
+
+class LessonQueue:
+    """
+    The lesson steps of one session, in teaching order.
+    getChunks fills it, start_signal peeks at the next tutor and getLearningContent hands the step out.
+    The remaining steps are also saved in the graph state (lesson_plan) so a resumed session gets them back.
+    """
+
+    def __init__(self, steps=()):
+        """
+        Args:
+            steps (list): the {"agent": ..., "content": ...} steps of the lesson.
+        """
+        self._steps = deque(steps)
+
+    def load(self, steps):
+        ''' replaces the remaining steps, e.g. with a new lesson plan or the one saved in a checkpoint '''
+        self._steps = deque({"agent": step["agent"], "content": step["content"]} for step in steps)
+
+    def next_agent(self):
+        ''' the tutor of the next step, None when the lesson is over '''
+        return self._steps[0]["agent"] if self._steps else None
+
+    def pop(self):
+        ''' removes and returns the next step, None when the lesson is over '''
+        return self._steps.popleft() if self._steps else None
+
+    def to_list(self) -> list:
+        return list(self._steps)
+
+    def __len__(self):
+        return len(self._steps)
+
 
 class MessageState:
     """
     A class to manage the state of messages and events for asynchronous communication.
+    Every tutoring session owns one MessageState, with its own bounded queues for
+    AI messages, user inputs and acknowledgments.
     """
 
-    def __init__(self):
+    def __init__(self, session_id: str = None, user_id: str = None, maxsize: int = MAX_QUEUE_SIZE):
         """
-        Initializes the MessageState with default values and creates asyncio events.
+        Initializes the MessageState with default values and creates the asyncio queues.
+
+        Args:
+            session_id (str): the id of the session, also used as the graph thread_id.
+            user_id (str): the id of the learner.
+            maxsize (int): the maximum number of pending items per queue.
         """
+        self.session_id = session_id
+        self.user_id = user_id
         self.content = "-"
         self.agent_name = "-"
-        self.event = asyncio.Event()
-        self.user_input_event = asyncio.Event()
-        self.acknowledgment_event = asyncio.Event()
         self.user_input = ""
+        self.ai_messages = asyncio.Queue(maxsize=maxsize)
+        self.user_inputs = asyncio.Queue(maxsize=maxsize)
+        self.acknowledgments = asyncio.Queue(maxsize=maxsize)
+        self.last_activity = time.monotonic()
+        self.task = None  # the asyncio task running the graph for this session
+        self.lessons = LessonQueue()
+        from prefetch import LessonPrefetcher  # not at the top: prefetch.py imports metrics.py, which imports this module
+        self.prefetch = LessonPrefetcher()  # lessons prepared while the communicator talks
+        self.summary_task = None  # the rolling summary being written in the background (see context.py)
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
 
-    async def wait_for_update(self):
+    def touch(self):
         """
-        Waits for the event to be set, indicating that the message content has been updated.
+        Marks the session as active so it is not evicted.
+        """
+        self.last_activity = time.monotonic()
+
+    def _call_in_loop(self, func, *args):
+        ''' tools can run in a worker thread, asyncio queues must only be used from the loop thread '''
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self._loop is None or running_loop is self._loop:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _put_message(self, message):
+        # a stale acknowledgment must not release the wait for this new message
+        while not self.acknowledgments.empty():
+            self.acknowledgments.get_nowait()
+        if self.ai_messages.full():
+            # the client is not reading, drop the oldest message rather than blocking the graph
+            self.ai_messages.get_nowait()
+            print(f'[WARNING] - message queue full for session {self.session_id}, dropping oldest message')
+        self.ai_messages.put_nowait(message)
+
+    def _put_delta(self, delta):
+        # deltas are only a preview of the final message, they are dropped rather than
+        # taking the room of complete messages when the client falls behind
+        if self.ai_messages.qsize() < self.ai_messages.maxsize // 2:
+            self.ai_messages.put_nowait(delta)
+
+    def _put_discard(self, discard):
+        # unlike a delta it is never dropped while there is room, the client would keep showing the preview
+        if not self.ai_messages.full():
+            self.ai_messages.put_nowait(discard)
+
+    def _put_acknowledgment(self):
+        if not self.acknowledgments.full():
+            self.acknowledgments.put_nowait(True)
+
+    async def wait_for_update(self, include_deltas: bool = False):
+        """
+        Waits for the next message produced by the agents.
+
+        Args:
+            include_deltas (bool): also return the partial token deltas streamed before a complete message,
+                and the "discard" events dropping them.
 
         Returns:
-            dict: A dictionary containing the updated content and agent name.
+            dict: A dictionary containing the message type ("message", "delta" or "discard"), the content and agent name.
         """
-        await self.event.wait()
-        self.event.clear()
-        return {"content": self.content, "agent_name": self.agent_name}
+        while True:
+            message = await self.ai_messages.get()
+            self.touch()
+            if include_deltas or message["type"] == "message":
+                return message
 
     def update_content(self, new_content, new_agent_name):
         """
-        Updates the message content and agent name, and sets the event to notify waiting coroutines.
+        Updates the message content and agent name, and queues the message for the client.
 
         Args:
             new_content (str): The new content of the message.
@@ -37,42 +151,155 @@ class MessageState:
         """
         self.content = new_content
         self.agent_name = new_agent_name
-        self.event.set()
+        self.touch()
+        self._call_in_loop(self._put_message, {"type": "message", "content": new_content, "agent_name": new_agent_name})
         print('successfully updated content!')
 
+    def push_delta(self, delta, agent_name):
+        """
+        Queues a partial piece of an agent message while it is being generated.
+        The complete message is still sent with update_content once the routers have inspected it.
+
+        Args:
+            delta (str): The new tokens.
+            agent_name (str): The name of the agent generating the message.
+        """
+        self._call_in_loop(self._put_delta, {"type": "delta", "content": delta, "agent_name": agent_name})
+
+    def discard_deltas(self, agent_name):
+        """
+        Tells the client to drop the deltas streamed for a message that will not be sent complete
+        (the agent wrote some text before calling a tool).
+
+        Args:
+            agent_name (str): The name of the agent whose deltas are dropped.
+        """
+        self._call_in_loop(self._put_discard, {"type": "discard", "content": "", "agent_name": agent_name})
+
     async def wait_for_input(self):
         """
-        Waits for the user input event to be set, indicating that user input has been received.
+        Waits for the next user input.
 
         Returns:
             str: The user input.
         """
-        await self.user_input_event.wait()
-        self.user_input_event.clear()
+        self.user_input = await self.user_inputs.get()
+        self.touch()
         return self.user_input
 
     def update_user_input(self, user_input):
         """
-        Updates the user input and sets the user input event to notify waiting coroutines.
+        Queues the input provided by the user.
 
         Args:
             user_input (str): The input provided by the user.
+
+        Raises:
+            asyncio.QueueFull: if the session already has too many pending inputs.
         """
-        self.user_input = user_input
-        self.user_input_event.set()
+        self.touch()
+        self.user_inputs.put_nowait(user_input)
 
     async def wait_for_acknowledgment(self):
         """
-        Waits for the acknowledgment event to be set, indicating that the message has been acknowledged.
+        Waits until the client acknowledged the last message.
         """
-        await self.acknowledgment_event.wait()
-        self.acknowledgment_event.clear()
+        await self.acknowledgments.get()
+        self.touch()
 
     def acknowledge_message(self):
         """
-        Sets the acknowledgment event to indicate that the message has been acknowledged.
+        Records that the client acknowledged the last message.
+        """
+        self.touch()
+        self._call_in_loop(self._put_acknowledgment)
+
+
+class SessionRegistry:
+    """
+    Keeps one MessageState per tutoring session, keyed by session ID.
+    """
+
+    def __init__(self, idle_timeout: float = SESSION_IDLE_TIMEOUT, max_queue_size: int = MAX_QUEUE_SIZE):
+        self.idle_timeout = idle_timeout
+        self.max_queue_size = max_queue_size
+        self._sessions = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def create(self, user_id: str = None, session_id: str = None) -> MessageState:
+        """
+        Creates a new session.
+
+        Args:
+            user_id (str): the id of the learner.
+            session_id (str): optional id to use, a random one is generated otherwise.
+
+        Returns:
+            MessageState: the state of the new session.
         """
-        self.acknowledgment_event.set()
+        session_id = session_id or uuid.uuid4().hex
+        session = MessageState(session_id=session_id, user_id=user_id, maxsize=self.max_queue_size)
+        self._sessions[session_id] = session
+        return session
 
-# Create an instance of MessageState to manage the message state globally.
-message_state = MessageState()
\ No newline at end of file
+    def get(self, session_id: str) -> MessageState:
+        """
+        Returns the session with this id, or None if it does not exist (or was evicted).
+        """
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    def remove(self, session_id: str):
+        """
+        Removes a session and cancels its graph task if it is still running.
+        """
+        session = self._sessions.pop(session_id, None)
+        if session is not None and session.task is not None and not session.task.done():
+            session.task.cancel()
+        if session is not None:
+            session.prefetch.cancel()
+            if session.summary_task is not None:
+                session.summary_task.cancel()
+        return session
+
+    def evict_idle(self, now: float = None) -> list:
+        """
+        Removes every session that has been idle for longer than idle_timeout.
+
+        Returns:
+            list: the ids of the evicted sessions.
+        """
+        now = time.monotonic() if now is None else now
+        expired = [session_id for session_id, session in self._sessions.items()
+                   if now - session.last_activity > self.idle_timeout]
+        for session_id in expired:
+            self.remove(session_id)
+        return expired
+
+
+# registry of all the sessions served by this process
+sessions = SessionRegistry()
+
+
+def get_message_state() -> MessageState:
+    """
+    Returns the MessageState of the session the current graph run belongs to.
+
+    Raises:
+        LookupError: if no session is bound to the current context or if it was evicted.
+    """
+    session_id = current_session_id.get()
+    session = sessions.get(session_id) if session_id is not None else None
+    if session is None:
+        raise LookupError(f'No active session for session id {session_id}')
+    return session
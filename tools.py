@@ -1,41 +1,47 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 from langchain_core.tools import tool
 import json
 from langgraph.checkpoint import *
 import re
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OpenAIEmbeddings
-import chromadb
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
-from state import message_state
+from retrieval import get_retrieval_service
+from lesson_plan import lookup_lesson_plan
+from llm_cache import get_llm_cache, make_key
+from user_store import get_user_store, get_curriculum
+from state import get_message_state
 import ast
+import time
+from metrics import LLM_SECONDS, LLM_TOKENS
 
 
 GPT_MODEL = "gpt-4-turbo"
 
+_openai_client = None
+
+def get_openai_client() -> AsyncOpenAI:
+    ''' shared async OpenAI client, created on first use so importing this file does not need an API key '''
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI()
+    return _openai_client
+
 @tool
 def getFiles(userID: str) -> str:
     ''' read the user profile, user progress file and the curriculum '''
-    #init the values we need as None to check later if we were able to retrieve data
-    #ideally find more efficient way to do this
-    profile = None
-    progress = None
+    # one indexed lookup per user instead of parsing every file (see user_store.py)
+    store = get_user_store()
 
     # retrieving the user's profile NOT USEFUL RN
-    with open('data/user_profile_file.json', 'r') as json_file:
-        profile = json.load(json_file).get(userID, None)
+    profile = store.get_profile(userID)
     if profile == None: #in case we couldnt find user profile
         return f'User profile not existant for user {userID}. Please double check user ID'
     
     #retrieving the user progress
-    with open('data/user_progress_file.json', 'r') as json_file:
-        progress = json.load(json_file).get(userID, None)
+    progress = store.get_progress(userID)
 
     if progress == None: #in case we couldnt find user progress
         return f'User progress not existant for user {userID}. Please double check user ID'  
 
-    with open('data/curriculum.txt', 'r') as file:
-        curriculum = file.read()
+    curriculum = get_curriculum()
     if not curriculum:
         return f'Could not retrieve any text from curriculum.txt, please double check file contents'
 
@@ -47,38 +53,32 @@ def getFiles(userID: str) -> str:
 @tool #! right now we will not implement this
 def updateUserPreferences(userID: str, newPreferences: list) -> str:
     ''' tool to update the entries in user_profile_file for a specific user'''
-    with open('data/user_profile_file.json', 'r') as json_file:
-        data = json.load(json_file)
-    
-    if userID in data:
-        data[userID]['preferences'] = newPreferences
-    else:
+    if not get_user_store().update_preferences(userID, newPreferences):
         print(f"No user found with ID: {userID}")
         return
-    
-    with open('data/user_profile_file.json', 'w') as file:
-        json.dump(data, file, indent=4)
 
     return 'Successfully updated the user profile'
 
-@tool
-def getChunks(query: str) -> str:
-    ''' use an llm to seperate the texts '''
-    #print('seperating chunks...')
-    ''' add: fulldata -> apply query -> get all_contents (filtered in this case)'''
+async def prepare_lesson(query: str) -> list:
+    """
+    Builds the plan of the lesson asked for in a query, without touching the session.
+    Called by getChunks, and ahead of it by the prefetcher of the session while the communicator
+    is still talking with the learner (see prefetch.py).
+
+    Returns:
+        list: the ordered [{"agent": ..., "content": ...}] steps of the lesson.
 
-    model_name = "BAAI/bge-large-en-v1.5"
-    encode_kwargs = {'normalize_embeddings': True} # set True to compute cosine similarity
-    model_norm = HuggingFaceBgeEmbeddings(
-        model_name=model_name,
-        model_kwargs={'device': 'cpu'},
-        encode_kwargs=encode_kwargs
-    )
-    embeddings = model_norm
-    persist_directory = "data/bge_test_"
-    vectordb = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
-    retriever = vectordb.as_retriever(search_kwargs={"k": 3})
-    docs = retriever.invoke(query)
+    Raises:
+        Exception: if the LLM split of the retrieved chunks could not be parsed.
+    """
+    # the curriculum lessons are already split per agent offline (see lesson_plan.py), no retrieval or LLM needed
+    plan = lookup_lesson_plan(query)
+    if plan is not None:
+        print(f'--lesson plan found in the index: {[step["agent"] for step in plan]}')
+        return plan
+
+    # the embedder and the vector store are loaded once per process (see retrieval.py)
+    docs = await get_retrieval_service().aretrieve(query)
 
     new_docs = '' #change name
     for doc in docs:
@@ -89,10 +89,6 @@ def getChunks(query: str) -> str:
 
     print('\n\n')
 
-    message_state.update_content('succesfully retrieved content!', 'system')
-    # # WAIT FOR ACK TO SEE IF CLIENT RECIEVED AIMESSAGE
-    # await message_state.wait_for_acknowledgment()
-
     prompt = f'''for this query : {query} you decide witch chunk is adequate and relevant . 
     A chunk of content is a raw block of test preceded by a kapitel and a thema.
     For each chunk, assign an agent to this chunk. Keep ALL OF THE INHALT of a content block
@@ -106,62 +102,82 @@ def getChunks(query: str) -> str:
     IT IS MANDATORY THAT both lists are THE SAME SIZE
     OUTPUT ONLY THE TWO LISTS
             '''
-    try:
-        response = OpenAI().chat.completions.create(
+    messages = [
+        {"role": "system", "content": prompt},  # IN THEORY this prompt works (could use 1.few shots or 2.fine tuning for larger datasets)
+        {"role": "user", "content": new_docs}
+    ]
+    # the same lesson always gives the same prompt, the split is deterministic (temperature 0) so it can be cached
+    cache_key = make_key(GPT_MODEL, 0.0, messages)
+    output_string = get_llm_cache().get(cache_key)
+    if output_string is None:
+        start = time.perf_counter()
+        response = await get_openai_client().chat.completions.create(
             model= GPT_MODEL,
-            messages=[
-                {"role": "system", "content": prompt},  # IN THEORY this prompt works (could use 1.few shots or 2.fine tuning for larger datasets)
-                {"role": "user", "content": new_docs}
-            ],
+            messages=messages,
             temperature=0.0,
         )
+        LLM_SECONDS.observe(time.perf_counter() - start, agent='getChunks', cached='false')
+        if response.usage is not None:
+            LLM_TOKENS.inc(response.usage.prompt_tokens, agent='getChunks', kind='prompt')
+            LLM_TOKENS.inc(response.usage.completion_tokens, agent='getChunks', kind='completion')
         print("\n\n\n the output \n\n\n ")
         print(response.choices[0].message.content)
         print("\n\n\n")
 
         output_string = response.choices[0].message.content # == ' list 1\n list2 '
-        # Applying regex patterns to extract the lists
-        list1_matches = re.findall(r'"\s*([^"]+?)\s*"', output_string.splitlines()[0])
-        list2_matches = re.findall(r'"\s*([^"]+?)\s*"', output_string.splitlines()[1])
-
-        global agent_activation_order
-
-        global global_prompts_list
+    # Applying regex patterns to extract the lists
+    list1_matches = re.findall(r'"\s*([^"]+?)\s*"', output_string.splitlines()[0])
+    list2_matches = re.findall(r'"\s*([^"]+?)\s*"', output_string.splitlines()[1])
 
-        # Using ast.literal_eval to safely evaluate the lists
-        agent_activation_order = ast.literal_eval('[' + ', '.join(f'"{m}"' for m in list1_matches) + ']')
-        global_prompts_list = ast.literal_eval('[' + ', '.join(f'"{m}"' for m in list2_matches) + ']')
-        
+    # Using ast.literal_eval to safely evaluate the lists
+    agent_activation_order = ast.literal_eval('[' + ', '.join(f'"{m}"' for m in list1_matches) + ']')
+    prompts_list = ast.literal_eval('[' + ', '.join(f'"{m}"' for m in list2_matches) + ']')
+    
 
-        #check that the two lists are properly configured
-        print('Testing getChunks output:')
-        for elem in global_prompts_list:
-            print('-----')
-            print(elem)
-        print(agent_activation_order)
+    #check that the two lists are properly configured
+    print('Testing getChunks output:')
+    for elem in prompts_list:
+        print('-----')
+        print(elem)
+    print(agent_activation_order)
 
-        assert len(global_prompts_list) == len(agent_activation_order), f'should have as many topics as tutor lessons!, {len(global_prompts_list), len(agent_activation_order)}'
-        return 'continue'
+    assert len(prompts_list) == len(agent_activation_order), f'should have as many topics as tutor lessons!, {len(prompts_list), len(agent_activation_order)}'
+    get_llm_cache().set(cache_key, output_string) # only splits that could be parsed are cached
+    return [{'agent': agent, 'content': content} for agent, content in zip(agent_activation_order, prompts_list)]
+    
+@tool
+async def getChunks(query: str) -> str:
+    ''' use an llm to seperate the texts '''
+    #print('seperating chunks...')
+    ''' add: fulldata -> apply query -> get all_contents (filtered in this case)'''
+    message_state = get_message_state()
+    try:
+        # the lesson may already be prepared (or being prepared) since the communicator recommended it
+        plan = await message_state.prefetch.take(query)
+        if plan is None:
+            plan = await prepare_lesson(query)
     except Exception as e:
         print("Unable to generate ChatCompletion response")
         print(f"Exception: {e}")
         return e
+    # the lesson steps are kept per session, concurrent learners each get their own sequence
+    message_state.lessons.load(plan)
+    message_state.update_content('succesfully retrieved content!', 'system')
+    return 'continue'
     
 ''' TOOLS FOR THE TRACKER 
 '''
 @tool
 def start_signal() -> str:
     ''' function to determine what agent need to be woken up
-    ex: agentName <-> the ID present in the shared list between orchestrator and tracker
+    ex: agentName <-> the next step of the session lesson queue (see LessonQueue in state.py)
     output -> "conversational" <-> used by the router to know where to go in the graph
     '''
-    #print(agent_activation_order)
-    if len(agent_activation_order) != 0: #if there are agents left to execute
-        agent = agent_activation_order[0]
+    agent = get_message_state().lessons.next_agent()
+    if agent is not None: #if there are agents left to execute
         assert type(agent) == str, f'type of agent incorrect (should be string but got {type(agent)})'
-        #print(agent)
         return agent
-    else: #list is empty here
+    else: #queue is empty here
         return 'no_more_lesson'
     
 ''' tool function for all tutor agents to retrieve their prompts 
@@ -169,17 +185,13 @@ this function will probably need some tuning and tests to ensure there are no pr
 '''
 @tool 
 def getLearningContent() -> str:
-    ''' return the first element of the global prompts list '''
-    prompt = global_prompts_list[0] # -> 'Content' -> retrive content
+    ''' return the content of the next lesson step of the session '''
+    step = get_message_state().lessons.pop() # O(1), the steps are a deque
+    if step is None:
+        return 'no lesson content left, call create_progress_report'
+    prompt = step['content']
     assert type(prompt) == str, 'prompt is not a string...'
-    # print(f'BEFORE RETRIEVAL: \ncontents = {global_prompts_list} \nagents = {agent_activation_order}')
-    global_prompts_list.pop(0)
-    agent_name = agent_activation_order[0]
-    # debugging
-    # print(f"Retrieved content {prompt} for agent {agent_name}")
-    agent_activation_order.pop(0)
-    #print(f'AFTER RETRIEVAL: \ncontents = {global_prompts_list} \nagents = {agent_activation_order}')
-    return agent_name + ' lesson: ' + prompt #what is gonna be returned to the tutor agent
+    return step['agent'] + ' lesson: ' + prompt #what is gonna be returned to the tutor agent
 
 @tool
 def create_progress_report(agentName: str, reportAndFeedback=None) -> str: 
@@ -0,0 +1,138 @@
+'''
+Micro-batching of TTS requests.
+Synthesizer.tts runs the VITS model on one utterance at a time. Under classroom load many short sentences
+arrive together, so the requests are collected for a few milliseconds and synthesized as one padded batch
+(Vits.inference supports batches through x_lengths), then the waveforms are cut back per request.
+Only requests with the same speaker and language are batched together. If the batch cannot run (another
+model type, an error...) the texts are synthesized one after the other with Synthesizer.tts.
+'''
+
+import asyncio
+import os
+
+import numpy as np
+
+from tts.tts import TRAILING_SILENCE, to_pcm16
+
+# maximum number of sentences synthesized in one batch, 1 disables batching
+TTS_BATCH_MAX_SIZE = int(os.getenv("TTS_BATCH_MAX_SIZE", "8"))
+# how long the first request of a batch waits for others (in milliseconds)
+TTS_BATCH_MAX_WAIT_MS = float(os.getenv("TTS_BATCH_MAX_WAIT_MS", "10"))
+
+
+def synthesize_batch(synthesizer, texts: list, speaker_name: str = "Judith", language_name: str = 'x-lb') -> list:
+    """
+    Synthesizes several texts in one forward pass of the VITS model.
+
+    Args:
+        synthesizer: the TTS synthesizer defined by the setupTTS function
+        texts: the texts to synthesize, ideally of similar length
+        speaker_name: the voice, the same for all the texts
+        language_name: the language, the same for all the texts
+
+    Returns:
+        list: one float waveform (numpy array) per text, followed by the same silence as Synthesizer.tts adds
+    """
+    import torch
+
+    model = synthesizer.tts_model
+    token_ids = [model.tokenizer.text_to_ids(text, language=language_name) for text in texts]
+    x_lengths = torch.tensor([len(ids) for ids in token_ids], dtype=torch.long)
+    x = torch.zeros((len(texts), int(x_lengths.max())), dtype=torch.long)  # padding is masked by x_lengths
+    for i, ids in enumerate(token_ids):
+        x[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+    speaker_ids = torch.full((len(texts),), model.speaker_manager.name_to_id[speaker_name], dtype=torch.long)
+    language_ids = torch.full((len(texts),), model.language_manager.name_to_id[language_name], dtype=torch.long)
+
+    with torch.no_grad():
+        outputs = model.inference(x, aux_input={"x_lengths": x_lengths, "speaker_ids": speaker_ids,
+                                                "language_ids": language_ids})
+    waveforms = outputs["model_outputs"].squeeze(1).cpu().numpy()  # [B, T_wav]
+    # each decoder frame is hop_length samples, y_mask tells how many frames belong to each text
+    frames = outputs["y_mask"].sum(dim=(1, 2)).long().tolist()
+    hop_length = model.config.audio.hop_length
+    silence = np.zeros(TRAILING_SILENCE, dtype=np.float32)
+    return [np.concatenate([waveforms[i, :n * hop_length], silence]) for i, n in enumerate(frames)]
+
+
+def synthesize_sequential(synthesizer, texts: list, speaker_name: str = "Judith", language_name: str = 'x-lb') -> list:
+    ''' same result as synthesize_batch, one Synthesizer.tts call per text '''
+    return [np.asarray(synthesizer.tts(text, speaker_name, language_name), dtype=np.float32) for text in texts]
+
+
+def synthesize_batch_pcm16(synthesizer, texts: list, speaker_name: str = "Judith", language_name: str = 'x-lb') -> list:
+    """
+    Batched version of synthesize_pcm16: returns one PCM16 bytes object per text.
+    Falls back to sequential synthesis when the batch cannot run.
+    """
+    if len(texts) > 1:
+        try:
+            return [to_pcm16(wav) for wav in synthesize_batch(synthesizer, texts, speaker_name, language_name)]
+        except Exception as e:
+            print(f"[WARNING] - batched TTS failed, synthesizing sequentially: {e}")
+    return [to_pcm16(wav) for wav in synthesize_sequential(synthesizer, texts, speaker_name, language_name)]
+
+
+class MicroBatcher:
+    """
+    Collects the synthesis requests arriving within max_wait_ms and runs them as one batch.
+    """
+
+    def __init__(self, run, max_batch_size: int = TTS_BATCH_MAX_SIZE, max_wait_ms: float = TTS_BATCH_MAX_WAIT_MS):
+        """
+        Args:
+            run (coroutine function): runs func(synthesizer, *args) on a worker, TTSWorkerPool.run.
+            max_batch_size (int): a batch is sent as soon as it has this many requests.
+            max_wait_ms (float): latency budget, a batch is sent at the latest this long after its first request.
+        """
+        self.run = run
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._waiting = {}  # (speaker_name, language_name) -> [(text, future)]
+        self._timers = {}
+        self.batches = 0
+        self.batched_requests = 0
+
+    async def synthesize_pcm16(self, text: str, speaker_name: str = "Judith", language_name: str = 'x-lb') -> bytes:
+        """
+        Queues text for the next batch of this speaker and language and returns its PCM16 bytes.
+        """
+        group = (speaker_name, language_name)
+        future = asyncio.get_running_loop().create_future()
+        waiting = self._waiting.setdefault(group, [])
+        waiting.append((text, future))
+        if len(waiting) >= self.max_batch_size:
+            self._send(group)
+        elif group not in self._timers:
+            self._timers[group] = asyncio.get_running_loop().call_later(self.max_wait, self._send, group)
+        return await future
+
+    def _send(self, group):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = [(text, future) for text, future in self._waiting.pop(group, []) if not future.cancelled()]
+        if batch:
+            asyncio.ensure_future(self._run_batch(group, batch))
+
+    async def _run_batch(self, group, batch):
+        self.batches += 1
+        self.batched_requests += len(batch)
+        try:
+            results = await self.run(synthesize_batch_pcm16, [text for text, _ in batch], *group)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), pcm in zip(batch, results):
+            if not future.done():
+                future.set_result(pcm)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else None,
+        }
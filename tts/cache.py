@@ -0,0 +1,287 @@
+'''
+Cache of synthesized audio.
+Greetings, tutor prompts and lesson sentences come back for every learner, so the audio of a sentence is
+synthesized once and then served from the cache. Entries are keyed by the normalized text, the speaker
+and the language, and kept in two tiers:
+- memory: raw PCM16 samples in an LRU bounded by TTS_CACHE_MEMORY_MB
+- disk: one file per entry in TTS_CACHE_DIR, bounded by TTS_CACHE_DISK_MB (least recently used files are
+  removed first), stored as wav, flac (lossless, default) or opus (lossy, smallest)
+
+synthesize data/relevant_content.txt ahead of time with: python -m tts.cache prewarm
+'''
+
+import hashlib
+import io
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+import soundfile as sf
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "data/tts_cache")
+TTS_CACHE_MEMORY_MB = float(os.getenv("TTS_CACHE_MEMORY_MB", "64"))
+TTS_CACHE_DISK_MB = float(os.getenv("TTS_CACHE_DISK_MB", "1024"))
+TTS_CACHE_FORMAT = os.getenv("TTS_CACHE_FORMAT", "flac")
+CACHE_SAMPLE_RATE = 16000  # sample rate of the model (tts/config.json)
+
+# format name -> (soundfile format, subtype, file extension)
+_FORMATS = {
+    'wav': ('WAV', 'PCM_16', '.wav'),
+    'flac': ('FLAC', 'PCM_16', '.flac'),
+    'opus': ('OGG', 'OPUS', '.ogg'),
+}
+
+
+def normalize_tts_text(text: str) -> str:
+    ''' the multilingual cleaner of the model lowercases and collapses spaces, so these variants sound the same '''
+    return ' '.join(unicodedata.normalize('NFC', text).lower().split())
+
+
+def audio_cache_key(text: str, speaker_name: str = "Judith", language_name: str = 'x-lb') -> str:
+    """
+    Builds the cache key of a synthesis request.
+
+    Returns:
+        str: the sha256 of the normalized text, the speaker and the language.
+    """
+    payload = '\x1f'.join([normalize_tts_text(text), speaker_name, language_name])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AudioCache:
+    """
+    Two tier (memory, disk) cache of PCM16 audio with size limits and hit/miss counters.
+    Safe to share between the TTS workers.
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, memory_mb: float = TTS_CACHE_MEMORY_MB,
+                 disk_mb: float = TTS_CACHE_DISK_MB, audio_format: str = TTS_CACHE_FORMAT):
+        """
+        Args:
+            directory (str): where the disk tier is stored.
+            memory_mb (float): size of the memory tier, 0 disables it.
+            disk_mb (float): size of the disk tier, 0 disables it.
+            audio_format (str): 'wav', 'flac' or 'opus', the format of the files on disk.
+        """
+        if audio_format not in _FORMATS:
+            raise ValueError(f"Unknown TTS_CACHE_FORMAT: {audio_format} (expected one of {list(_FORMATS)})")
+        self.directory = directory
+        self.memory_bytes = int(memory_mb * 1024 * 1024)
+        self.disk_bytes = int(disk_mb * 1024 * 1024)
+        self.audio_format = audio_format
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> pcm bytes, least recently used first
+        self._memory_size = 0
+        self._files = OrderedDict()  # key -> file size, least recently used first
+        self._disk_size = 0
+        if self.disk_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _FORMATS[self.audio_format][2])
+
+    def _scan_disk(self):
+        ''' rebuilds the disk index from the files left by previous runs, oldest access first '''
+        extension = _FORMATS[self.audio_format][2]
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(extension):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name[:-len(extension)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._files[key] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def _remember(self, key: str, pcm: bytes):
+        if len(pcm) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = pcm
+        self._memory_size += len(pcm)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _encode(self, pcm: bytes) -> bytes:
+        file_format, subtype, _ = _FORMATS[self.audio_format]
+        buffer = io.BytesIO()
+        sf.write(buffer, np.frombuffer(pcm, dtype='<i2'), CACHE_SAMPLE_RATE, format=file_format, subtype=subtype)
+        return buffer.getvalue()
+
+    def _decode(self, path: str) -> bytes:
+        samples, _ = sf.read(path, dtype='int16')
+        return samples.astype('<i2').tobytes()
+
+    def get(self, key: str):
+        """
+        Returns the PCM16 bytes cached for this key, None on a miss.
+        A hit on disk is promoted to the memory tier.
+        """
+        with self._lock:
+            pcm = self._memory.get(key)
+            if pcm is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return pcm
+            on_disk = key in self._files
+            if on_disk:
+                self._files.move_to_end(key)
+        if on_disk:
+            path = self._path(key)
+            try:
+                pcm = self._decode(path)
+                os.utime(path)  # keeps the access order across restarts
+            except Exception as e:
+                print(f"[WARNING] - unreadable TTS cache entry {path}: {e}")
+                pcm = None
+        with self._lock:
+            if pcm is None:
+                if on_disk and key in self._files:
+                    self._disk_size -= self._files.pop(key)
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, pcm)
+            return pcm
+
+    def put(self, key: str, pcm: bytes):
+        """
+        Stores PCM16 bytes in both tiers and evicts the least recently used entries above the size limits.
+        """
+        with self._lock:
+            self._remember(key, pcm)
+            if self.disk_bytes <= 0 or key in self._files:
+                return
+        data = self._encode(pcm)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)  # readers never see a half written file
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = len(data)
+                self._disk_size += len(data)
+            self._evict_disk()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._memory or key in self._files
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and the size of both tiers.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_mb": self._memory_size / (1024 * 1024),
+                "disk_entries": len(self._files),
+                "disk_mb": self._disk_size / (1024 * 1024),
+                "format": self.audio_format,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> AudioCache:
+    """
+    Returns the process-wide audio cache, the disk tier is scanned on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AudioCache()
+    return _cache
+
+
+def speech_text(content: str) -> str:
+    ''' the content blocks are markdown, drop the markup that would be read out loud '''
+    lines = []
+    for line in content.splitlines():
+        line = re.sub(r'^\s*(#+|[-*]|\d+\.)\s+', '', line)
+        line = line.replace('**', '').replace('|', ' ').strip()
+        if line and not re.fullmatch(r'[-:\s]+', line):
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+async def prewarm(content_path: str, speaker_name: str = "Judith", language_name: str = 'x-lb') -> dict:
+    """
+    Synthesizes every sentence of the curriculum content that is not cached yet.
+
+    Returns:
+        dict: the number of sentences found, already cached and synthesized.
+    """
+    import asyncio
+    from lesson_plan import parse_content_blocks
+    from tts.pool import TTSWorkerPool
+    from tts.tts import split_sentences
+
+    sentences = []
+    for block in parse_content_blocks(content_path):
+        sentences.extend(split_sentences(speech_text(block['content'])))
+    sentences = list(dict.fromkeys(sentences))
+    cache = get_audio_cache()
+    missing = [s for s in sentences if audio_cache_key(s, speaker_name, language_name) not in cache]
+    print(f"{len(sentences)} sentences, {len(sentences) - len(missing)} already cached")
+
+    pool = TTSWorkerPool(cache=cache)
+    await asyncio.to_thread(pool.start)
+    slots = asyncio.Semaphore(pool.max_pending)
+    done = 0
+
+    async def synthesize(sentence):
+        nonlocal done
+        async with slots:
+            await pool.synthesize_pcm(sentence, speaker_name, language_name)
+        done += 1
+        if done % 20 == 0 or done == len(missing):
+            print(f"  {done}/{len(missing)}")
+
+    try:
+        await asyncio.gather(*[synthesize(sentence) for sentence in missing])
+    finally:
+        pool.shutdown()
+    return {"sentences": len(sentences), "cached": len(sentences) - len(missing), "synthesized": len(missing)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="Fill the TTS audio cache.")
+    parser.add_argument("command", choices=["prewarm", "stats"])
+    parser.add_argument("--content", default="data/relevant_content.txt")
+    parser.add_argument("--speaker", default="Judith")
+    parser.add_argument("--language", default="x-lb")
+    args = parser.parse_args()
+    if args.command == "prewarm":
+        print(asyncio.run(prewarm(args.content, args.speaker, args.language)))
+    print(get_audio_cache().stats())
@@ -0,0 +1,177 @@
+'''
+TTS execution pool for the /tts endpoint.
+Synthesizer.tts is CPU bound and takes seconds for a long reply, so it never runs on the event loop:
+a bounded pool of worker threads, each holding its own warm Synthesizer, takes the requests.
+When too many requests are pending the pool refuses new ones (backpressure) instead of queueing forever.
+The audio stays in memory, there is no shared output file.
+With an AudioCache (tts/cache.py) each sentence is only synthesized the first time it is asked for, and
+sentences requested at the same time are synthesized in batches (tts/batching.py).
+'''
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import TTS_SECONDS
+from tts.batching import TTS_BATCH_MAX_SIZE, TTS_BATCH_MAX_WAIT_MS, MicroBatcher
+from tts.cache import audio_cache_key
+from tts.tts import pcm16_to_wav, setupTTS, split_sentences, synthesize_pcm16
+
+# number of worker threads, each one loads its own Synthesizer
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "2"))
+# requests accepted at once (running + waiting), above that the pool answers TTSQueueFull
+TTS_MAX_PENDING = int(os.getenv("TTS_MAX_PENDING", "16"))
+# how long a request waits for the models to be loaded (in seconds)
+TTS_STARTUP_TIMEOUT = float(os.getenv("TTS_STARTUP_TIMEOUT", "300"))
+
+
+class TTSQueueFull(Exception):
+    """
+    Raised when the pool already has TTS_MAX_PENDING requests.
+    """
+
+
+class TTSWorkerPool:
+    """
+    Bounded pool of TTS workers with one warm Synthesizer per worker.
+    """
+
+    def __init__(self, workers: int = TTS_WORKERS, max_pending: int = TTS_MAX_PENDING, synthesizer_factory=setupTTS,
+                 cache=None, batch_size: int = TTS_BATCH_MAX_SIZE, batch_wait_ms: float = TTS_BATCH_MAX_WAIT_MS):
+        """
+        Args:
+            workers (int): number of worker threads (and Synthesizer instances).
+            max_pending (int): maximum number of requests running or waiting.
+            synthesizer_factory (callable): builds one Synthesizer, setupTTS by default.
+            cache (AudioCache): cache of the synthesized sentences, None to always synthesize.
+            batch_size (int): maximum number of sentences synthesized together, 1 disables batching.
+            batch_wait_ms (float): how long a sentence waits for others to fill its batch.
+        """
+        self.workers = workers
+        self.cache = cache
+        self.batcher = MicroBatcher(self.run, batch_size, batch_wait_ms) if batch_size > 1 else None
+        self.max_pending = max_pending
+        self.synthesizer_factory = synthesizer_factory
+        self.ready = threading.Event()
+        self.error = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tts")
+        self._synthesizers = queue.Queue()
+        self._pending = 0
+        self._completed = 0
+        self._timings = deque(maxlen=1000)  # (start, end) of the last requests
+
+    def start(self):
+        """
+        Loads one Synthesizer per worker. Blocking, run it in a background thread at startup.
+        """
+        try:
+            try:
+                import torch
+                # the workers share the cores, without this each one would use all of them
+                torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.workers))
+            except ImportError:
+                pass
+            for _ in range(self.workers):
+                self._synthesizers.put(self.synthesizer_factory())
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.ready.set()
+
+    def _run(self, func, *args):
+        ''' runs in a worker thread with a Synthesizer borrowed from the pool '''
+        if not self.ready.wait(timeout=TTS_STARTUP_TIMEOUT):
+            raise RuntimeError("TTS models are still loading")
+        if self.error is not None:
+            raise RuntimeError(f"TTS could not be set up: {self.error}")
+        synthesizer = self._synthesizers.get()
+        try:
+            return func(synthesizer, *args)
+        finally:
+            self._synthesizers.put(synthesizer)
+
+    async def run(self, func, *args):
+        """
+        Runs func(synthesizer, *args) in the pool.
+
+        Raises:
+            TTSQueueFull: if max_pending requests are already running or waiting.
+        """
+        if self._pending >= self.max_pending:
+            raise TTSQueueFull(f"{self._pending} TTS requests already pending")
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._run, func, *args)
+        finally:
+            self._pending -= 1
+            self._completed += 1
+            self._timings.append((start, time.perf_counter()))
+            TTS_SECONDS.observe(self._timings[-1][1] - start, job=func.__name__)
+
+    async def synthesize_pcm(self, text: str, speaker_name: str = "Judith", language_name: str = 'x-lb') -> bytes:
+        """
+        Returns the PCM16 samples of text, from the cache if it was already synthesized.
+        """
+        if self.cache is None:
+            return await self._synthesize_pcm(text, speaker_name, language_name)
+        key = audio_cache_key(text, speaker_name, language_name)
+        pcm = await asyncio.to_thread(self.cache.get, key)
+        if pcm is None:
+            pcm = await self._synthesize_pcm(text, speaker_name, language_name)
+            await asyncio.to_thread(self.cache.put, key, pcm)
+        return pcm
+
+    async def _synthesize_pcm(self, text: str, speaker_name: str, language_name: str) -> bytes:
+        if self.batcher is not None:
+            return await self.batcher.synthesize_pcm16(text, speaker_name, language_name)
+        return await self.run(synthesize_pcm16, text, speaker_name, language_name)
+
+    async def synthesize(self, text: str, speaker_name: str = "Judith", language_name: str = 'x-lb') -> bytes:
+        """
+        Synthesizes text and returns the WAV bytes.
+        The text is synthesized sentence by sentence (as Synthesizer.tts does internally) so that the
+        sentences shared with other texts come from the cache. With batching the sentences are submitted
+        together and share the batches of the MicroBatcher, without it they run one after the other so
+        a long text only takes one of the max_pending slots.
+        """
+        sentences = split_sentences(text) or [text]
+        if self.batcher is not None:
+            unique = list(dict.fromkeys(sentences))  # a repeated sentence is synthesized once
+            pcms = await asyncio.gather(*[self.synthesize_pcm(sentence, speaker_name, language_name) for sentence in unique])
+            by_sentence = dict(zip(unique, pcms))
+            pcm = b''.join(by_sentence[sentence] for sentence in sentences)
+        else:
+            pcm = b''.join([await self.synthesize_pcm(sentence, speaker_name, language_name) for sentence in sentences])
+        return pcm16_to_wav(pcm)
+
+    def stats(self) -> dict:
+        """
+        Throughput and latency percentiles over the last requests.
+        """
+        timings = list(self._timings)
+        latencies = sorted(end - start for start, end in timings)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else None
+
+        window = (max(end for _, end in timings) - min(start for start, _ in timings)) if timings else 0
+        return {
+            "workers": self.workers,
+            "ready": self.ready.is_set() and self.error is None,
+            "pending": self._pending,
+            "completed": self._completed,
+            "throughput_rps": len(timings) / window if window else None,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "batching": self.batcher.stats() if self.batcher is not None else None,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,11 +1,10 @@
 import os
+import re
+import struct
+import numpy as np
 import requests
-import soundfile as sf
-import TTS
 
-from TTS.config import load_config
-from TTS.utils.manage import ModelManager
-from TTS.utils.synthesizer import Synthesizer
+# the TTS package (and torch) take seconds to import, they are only imported by setupTTS
 
 def download_file(url, filename):
     """
@@ -32,8 +31,10 @@ def setupTTS():
     Args:
         None
     Return:
-        synthesizer: TTS.utils.synthesizer.Synthesizer - this is the synthesizer to be used in the speak function later to convert Text into Audio
+        synthesizer: TTS.utils.synthesizer.Synthesizer - this is the synthesizer to be used by the synthesize functions later to convert Text into Audio
     """
+    from TTS.utils.synthesizer import Synthesizer
+
     model_path = "tts/best_model.pth"
     config_path = "tts/config.json"
     speakers_file_path = "tts/speakers.pth"
@@ -58,25 +59,75 @@ def setupTTS():
     return synthesizer
 
 
-def speak(synthesizer: TTS.utils.synthesizer.Synthesizer,
-          text: str,
-          speaker_name: str = "Judith",
-          language_name: str ='x-lb'):
+SAMPLE_RATE = 16000
+# silence (in samples) that Synthesizer.tts appends after each sentence
+TRAILING_SILENCE = 10000
+
+
+def split_sentences(text: str, max_chars: int = 200) -> list:
     """
-    This function uses the synthesizer to generate speech from text
+    Splits a text into sentences so they can be synthesized and played one after the other
     Args:
-        synthesizer: the TTS synthesizer defined by the setupTTS function
-        text: the text you want to convert into speech
-        speaker_name: the voice you want for your speech, choose a speaker between Judith, Luc, Sara or Charel, Judith is selected by default
-        language_name: the language you want to use. It is set to luxembourgish by default
+        text: the text to split
+        max_chars: sentences longer than this are split again on commas
+    Return:
+        list: the non empty sentences, in order
+    """
+    sentences = []
+    for part in re.split(r'(?<=[.!?…])\s+|\n+', text):
+        part = part.strip()
+        if not part:
+            continue
+        if len(part) <= max_chars:
+            sentences.append(part)
+            continue
+        current = ''
+        for piece in re.split(r'(?<=[,;:])\s+', part):
+            if current and len(current) + len(piece) + 1 > max_chars:
+                sentences.append(current)
+                current = piece
+            else:
+                current = f'{current} {piece}'.strip()
+        if current:
+            sentences.append(current)
+    return sentences
+
 
-    Returns:
-        Nothing is returned and the speech is saved as output.wav
+def synthesize_pcm16(synthesizer: 'TTS.utils.synthesizer.Synthesizer',
+                     text: str,
+                     speaker_name: str = "Judith",
+                     language_name: str = 'x-lb') -> bytes:
     """
-    wavs = synthesizer.tts(
-        text, 
-        speaker_name,
-        language_name
-    )
-    sf.write('output.wav', wavs, 16000)
-    print("Speech generated in speech/output.wav file")
\ No newline at end of file
+    Synthesizes text and returns raw 16 bit little endian PCM samples (no header), to be streamed after wav_stream_header
+    """
+    return to_pcm16(synthesizer.tts(text, speaker_name, language_name))
+
+
+def to_pcm16(wavs) -> bytes:
+    """
+    Converts a float waveform in [-1, 1] to 16 bit little endian PCM bytes
+    """
+    wavs = np.asarray(wavs, dtype=np.float32)
+    return (np.clip(wavs, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def _wav_header(riff_size: int, data_size: int, sample_rate: int) -> bytes:
+    return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+            + b'data' + struct.pack('<I', data_size))
+
+
+def wav_stream_header(sample_rate: int = SAMPLE_RATE) -> bytes:
+    """
+    WAV header for a mono 16 bit stream whose length is not known yet.
+    The sizes are set to the maximum value, which browsers and most players accept for streamed audio
+    """
+    unknown_size = 0xFFFFFFFF
+    return _wav_header(unknown_size, unknown_size, sample_rate)
+
+
+def pcm16_to_wav(pcm: bytes, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """
+    Wraps raw 16 bit PCM samples (see synthesize_pcm16) into a complete WAV file
+    """
+    return _wav_header(36 + len(pcm), len(pcm), sample_rate) + pcm
@@ -0,0 +1,257 @@
+'''
+User store used by the communicator tools (getFiles, updateUserPreferences).
+Reading the whole profile and progress JSON files on every request is O(number of users) and rewriting
+them is not safe when several sessions update profiles at the same time, so the store is pluggable:
+- "sqlite" (default): one row per user, primary key on userID, atomic per-user upserts and an in-memory
+  read-through cache for profiles. It is filled from the JSON files on first use.
+- "json": the original files, rewritten atomically.
+
+migrate the JSON files explicitly with: python user_store.py migrate
+'''
+
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+USER_STORE_BACKEND = os.getenv("USER_STORE_BACKEND", "sqlite")
+USER_STORE_PATH = os.getenv("USER_STORE_PATH", "data/users.sqlite")
+PROFILE_FILE = "data/user_profile_file.json"
+PROGRESS_FILE = "data/user_progress_file.json"
+CURRICULUM_FILE = "data/curriculum.txt"
+# number of profiles kept in memory by the sqlite store
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+
+
+def _read_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def _write_json_atomic(path: str, data: dict):
+    ''' write to a temporary file and rename it, readers never see a half written file '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class UserStore(ABC):
+    """
+    Interface of the user stores.
+    """
+
+    @abstractmethod
+    def get_profile(self, user_id: str):
+        ''' returns the profile dict of the user, None if unknown '''
+
+    @abstractmethod
+    def get_progress(self, user_id: str):
+        ''' returns the progress dict of the user, None if unknown '''
+
+    @abstractmethod
+    def upsert_profile(self, user_id: str, profile: dict):
+        ''' creates or replaces the profile of the user '''
+
+    @abstractmethod
+    def upsert_progress(self, user_id: str, progress: dict):
+        ''' creates or replaces the progress of the user '''
+
+    @abstractmethod
+    def update_preferences(self, user_id: str, preferences: list) -> bool:
+        ''' sets the preferences of an existing user, returns False if the user is unknown '''
+
+
+class JsonUserStore(UserStore):
+    """
+    The original JSON files. Files are parsed again only when they change on disk,
+    and writes are serialized and atomic.
+    """
+
+    def __init__(self, profile_file: str = PROFILE_FILE, progress_file: str = PROGRESS_FILE):
+        self.profile_file = profile_file
+        self.progress_file = progress_file
+        self._lock = threading.Lock()
+        self._parsed = {}  # path -> (mtime, data)
+
+    def _load(self, path: str) -> dict:
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        cached = self._parsed.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, _read_json(path))
+            self._parsed[path] = cached
+        return cached[1]
+
+    def _update(self, path: str, update) -> bool:
+        with self._lock:
+            data = dict(self._load(path))
+            result = update(data)
+            if result is False:
+                return False
+            _write_json_atomic(path, data)
+            self._parsed.pop(path, None)
+            return True
+
+    def get_profile(self, user_id: str):
+        return self._load(self.profile_file).get(user_id)
+
+    def get_progress(self, user_id: str):
+        return self._load(self.progress_file).get(user_id)
+
+    def upsert_profile(self, user_id: str, profile: dict):
+        self._update(self.profile_file, lambda data: data.__setitem__(user_id, profile))
+
+    def upsert_progress(self, user_id: str, progress: dict):
+        self._update(self.progress_file, lambda data: data.__setitem__(user_id, progress))
+
+    def update_preferences(self, user_id: str, preferences: list) -> bool:
+        def set_preferences(data):
+            if user_id not in data:
+                return False
+            data[user_id] = {**data[user_id], 'preferences': preferences}
+        return self._update(self.profile_file, set_preferences)
+
+
+class SQLiteUserStore(UserStore):
+    """
+    One row per user in SQLite, looked up by primary key.
+    Profiles are also kept in a bounded in-memory cache, updated on every write.
+    """
+
+    def __init__(self, path: str = USER_STORE_PATH, cache_size: int = PROFILE_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS progress (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            """
+        )
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0] == 0
+
+    def _cache_profile(self, user_id: str, profile):
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.cache_size:
+            self._profiles.popitem(last=False)
+
+    def _get(self, table: str, user_id: str):
+        row = self._conn.execute(f"SELECT data FROM {table} WHERE user_id = ?", (user_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _upsert(self, table: str, user_id: str, data: dict):
+        self._conn.execute(
+            f"INSERT INTO {table} (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            (user_id, json.dumps(data, ensure_ascii=False)),
+        )
+
+    def get_profile(self, user_id: str):
+        with self._lock:
+            if user_id in self._profiles:
+                self._profiles.move_to_end(user_id)
+                return self._profiles[user_id]
+            profile = self._get('profiles', user_id)
+            if profile is not None:
+                self._cache_profile(user_id, profile)
+            return profile
+
+    def get_progress(self, user_id: str):
+        with self._lock:
+            return self._get('progress', user_id)
+
+    def upsert_profile(self, user_id: str, profile: dict):
+        with self._lock, self._conn:
+            self._upsert('profiles', user_id, profile)
+            self._cache_profile(user_id, profile)
+
+    def upsert_progress(self, user_id: str, progress: dict):
+        with self._lock, self._conn:
+            self._upsert('progress', user_id, progress)
+
+    def update_preferences(self, user_id: str, preferences: list) -> bool:
+        with self._lock, self._conn:
+            # single statement, the read-modify-write of the profile is atomic
+            updated = self._conn.execute(
+                "UPDATE profiles SET data = json_set(data, '$.preferences', json(?)) WHERE user_id = ?",
+                (json.dumps(preferences, ensure_ascii=False), user_id),
+            ).rowcount
+            if updated:
+                self._cache_profile(user_id, self._get('profiles', user_id))
+            return updated > 0
+
+    def migrate_from_json(self, profile_file: str = PROFILE_FILE, progress_file: str = PROGRESS_FILE) -> dict:
+        """
+        Copies the users of the JSON files into the database (existing rows are overwritten).
+
+        Returns:
+            dict: the number of migrated profiles and progress entries.
+        """
+        profiles, progress = _read_json(profile_file), _read_json(progress_file)
+        with self._lock, self._conn:
+            for user_id, profile in profiles.items():
+                self._upsert('profiles', user_id, profile)
+            for user_id, entry in progress.items():
+                self._upsert('progress', user_id, entry)
+            self._profiles.clear()
+        return {"profiles": len(profiles), "progress": len(progress)}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_user_store() -> UserStore:
+    """
+    Returns the process-wide user store selected by USER_STORE_BACKEND.
+    The sqlite store is filled from the JSON files the first time it is created.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if USER_STORE_BACKEND == "json":
+                    _store = JsonUserStore()
+                elif USER_STORE_BACKEND == "sqlite":
+                    store = SQLiteUserStore()
+                    if store.is_empty():
+                        print(f"[INFO] - Migrating users to {store.path}: {store.migrate_from_json()}")
+                    _store = store
+                else:
+                    raise ValueError(f"Unknown USER_STORE_BACKEND: {USER_STORE_BACKEND} (expected 'sqlite' or 'json')")
+    return _store
+
+
+_curriculum_cache = {'mtime': None, 'text': None}
+
+
+def get_curriculum(path: str = CURRICULUM_FILE) -> str:
+    ''' the curriculum text, read again only when the file changes '''
+    mtime = os.path.getmtime(path)
+    if _curriculum_cache['mtime'] != mtime:
+        with open(path, 'r', encoding='utf-8') as file:
+            _curriculum_cache['text'] = file.read()
+        _curriculum_cache['mtime'] = mtime
+    return _curriculum_cache['text']
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] != ["migrate"]:
+        print("usage: python user_store.py migrate")
+        sys.exit(1)
+    print(f"migrated to {USER_STORE_PATH}: {SQLiteUserStore().migrate_from_json()}")